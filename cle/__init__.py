@@ -6,3 +6,5 @@ from .memory import *
 from .errors import *
 from .backends import *
 from .patched_stream import *
+from .cached_stream import *
+from .object_cache import *
@@ -5,6 +5,8 @@ import archinfo
 import subprocess
 from ..errors import CLECompatibilityError, CLEError
 from ..memory import Clemory
+from ..patched_stream import PatchedStream
+from ..cached_stream import BlockCachedStream
 
 try:
     import claripy
@@ -296,13 +298,18 @@ class Backend(object):
         for k,v in kwargs.iteritems():
             setattr(self, k, v)
 
+        # streams are read through a block cache, since parsing makes lots of small reads. PatchedStreams are expected to
+        # have one underneath them already.
         if hasattr(binary, 'seek') and hasattr(binary, 'read'):
             self.binary = filename
-            self.binary_stream = binary
+            if isinstance(binary, (PatchedStream, BlockCachedStream)):
+                self.binary_stream = binary
+            else:
+                self.binary_stream = BlockCachedStream(binary)
         else:
             self.binary = binary
             try:
-                self.binary_stream = open(binary, 'rb')
+                self.binary_stream = BlockCachedStream(open(binary, 'rb'))
             except IOError:
                 self.binary_stream = None
 
@@ -355,6 +362,16 @@ class Backend(object):
 
     supported_filetypes = []
 
+    def _clear_stream_cache(self):
+        """
+        Drop the blocks cached by the stream of this object, once parsing is done and it won't be read much any more.
+        """
+        stream = self.binary_stream
+        if isinstance(stream, PatchedStream):
+            stream = stream.stream
+        if isinstance(stream, BlockCachedStream):
+            stream.clear()
+
     def close(self):
         if self.binary_stream is not None:
             self.binary_stream.close()
@@ -34,16 +34,18 @@ class BackedCGC(CGC):
         self.permissions_map = permissions_map
         self.current_allocation_base = current_allocation_base
 
-        exec_seg_addr = None
+        exec_seg = None
         for seg in self.segments:
             if seg.is_executable:
-                exec_seg_addr = seg.vaddr
+                exec_seg = seg
                 break
         else:
             raise ValueError("Couldn't find executable segment?")
+        exec_seg_addr = exec_seg.vaddr
 
-        for start, _ in self.memory._backers:
-            if start != exec_seg_addr:
+        # a segment can be backed by its data and a zero backer after it, keep both for the executable one
+        for start, _ in list(self.memory._backers):
+            if not exec_seg.contains_addr(start):
                 self.memory.remove_backer(start)
 
         for start, data in sorted(self.memory_backer.items()):
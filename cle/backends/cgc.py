@@ -1,5 +1,6 @@
 from .elf import ELF
 from ..patched_stream import PatchedStream
+from ..cached_stream import BlockCachedStream
 
 ELF_HEADER = "7f45 4c46 0101 0100 0000 0000 0000 0000".replace(" ","").decode('hex')
 CGC_HEADER = "7f43 4743 0101 0143 014d 6572 696e 6f00".replace(" ","").decode('hex')
@@ -14,10 +15,10 @@ class CGC(ELF):
     def __init__(self, binary, *args, **kwargs):
         if hasattr(binary, 'seek'):
             filename = None
-            stream = PatchedStream(binary, [(0, ELF_HEADER)])
+            stream = PatchedStream(BlockCachedStream(binary), [(0, ELF_HEADER)])
         else:
             filename = binary
-            stream = PatchedStream(open(binary, 'rb'), [(0, ELF_HEADER)])
+            stream = PatchedStream(BlockCachedStream(open(binary, 'rb')), [(0, ELF_HEADER)])
 
         kwargs['filename'] = filename
         super(CGC, self).__init__(stream, *args, **kwargs)
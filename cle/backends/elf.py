@@ -1,3 +1,4 @@
+import copy
 import struct
 import subprocess
 from collections import OrderedDict
@@ -11,6 +12,8 @@ from .metaelf import MetaELF
 from ..relocations import get_relocation
 from ..relocations.generic import MipsGlobalReloc, MipsLocalReloc
 from ..patched_stream import PatchedStream
+from ..cached_stream import BlockCachedStream
+from ..memory import ClemoryStream, FileBacker, FileString, ZeroBacker
 
 import logging
 l = logging.getLogger('cle.elf')
@@ -102,8 +105,16 @@ class ELFSection(Section):
 class ELF(MetaELF):
     """
     The main loader class for statically loading ELF executables. Uses the pyreadelf library where useful.
+
+    Besides the common options, this backend takes `map_file`: whether to map the segments of the file into memory
+    instead of reading them in, so they are only paged in when they are read and are shared with every other object
+    mapping the same file. The file must not be modified while it is loaded this way (see :class:`FileBacker`).
+
+    Either way, the memory of an object loaded from a path refers back to the ranges of the file it was loaded from when
+    the object is pickled, so that only the changes made to it are stored (see :class:`FileString`).
     """
-    def __init__(self, binary, **kwargs):
+    def __init__(self, binary, map_file=False, **kwargs):
+        self.map_file = map_file
         super(ELF, self).__init__(binary, **kwargs)
 
         patch_undo = None
@@ -188,38 +199,50 @@ class ELF(MetaELF):
         if patch_undo is not None:
             self.memory.write_bytes(self.get_min_addr() + patch_undo[0], patch_undo[1])
 
+        self._clear_stream_cache()
+
     def __getstate__(self):
         if self.binary is None:
             raise ValueError("Can't pickle an object loaded from a stream")
+        state = dict(self.__dict__)
         if type(self.binary_stream) is PatchedStream:
-            self.binary_stream.stream = None
+            state['binary_stream'] = copy.copy(self.binary_stream)
+            state['binary_stream'].stream = None
         else:
-            self.binary_stream = None
-        self.reader = None
-        self.strtab = None
-        self.dynsym = None
-        self.hashtable = None
-        return self.__dict__
+            state['binary_stream'] = None
+        state['reader'] = None
+        state['strtab'] = None
+        state['dynsym'] = None
+        state['hashtable'] = None
+        return state
 
     def __setstate__(self, data):
         self.__dict__.update(data)
         if self.binary_stream is None:
-            self.binary_stream = open(self.binary, 'rb')
+            self.binary_stream = BlockCachedStream(open(self.binary, 'rb'))
         else:
-            self.binary_stream.stream = open(self.binary, 'rb')
+            self.binary_stream.stream = BlockCachedStream(open(self.binary, 'rb'))
+        self._open_tables()
+        self._clear_stream_cache()
+
+    def _open_tables(self):
+        """
+        Make the reader of the file and the string, symbol and hash tables of an object that was copied or unpickled,
+        over its own stream and memory. They each keep a position in them, so they can't be shared between copies.
+        """
         self.reader = elffile.ELFFile(self.binary_stream)
         if self._dynamic and 'DT_STRTAB' in self._dynamic:
             fakestrtabheader = {
                 'sh_offset': self._dynamic['DT_STRTAB']
             }
-            self.strtab = elffile.StringTableSection(fakestrtabheader, 'strtab_cle', self.memory)
+            self.strtab = elffile.StringTableSection(fakestrtabheader, 'strtab_cle', ClemoryStream(self.memory))
             if 'DT_SYMTAB' in self._dynamic and 'DT_SYMENT' in self._dynamic:
                 fakesymtabheader = {
                     'sh_offset': self._dynamic['DT_SYMTAB'],
                     'sh_entsize': self._dynamic['DT_SYMENT'],
                     'sh_size': 0
                 } # bogus size: no iteration allowed
-                self.dynsym = elffile.SymbolTableSection(fakesymtabheader, 'symtab_cle', self.memory, self.reader, self.strtab)
+                self.dynsym = elffile.SymbolTableSection(fakesymtabheader, 'symtab_cle', ClemoryStream(self.memory), self.reader, self.strtab)
                 if 'DT_GNU_HASH' in self._dynamic:
                     self.hashtable = GNUHashTable(self.dynsym, self.memory, self._dynamic['DT_GNU_HASH'], self.arch)
                 elif 'DT_HASH' in self._dynamic:
@@ -270,21 +293,21 @@ class ELF(MetaELF):
             arr_start = self._dynamic['DT_PREINIT_ARRAY']
             arr_end = arr_start + self._dynamic['DT_PREINIT_ARRAYSZ']
             arr_entsize = self.arch.bytes
-            self._preinit_arr = map(self.memory.read_addr_at, range(arr_start, arr_end, arr_entsize))
+            self._preinit_arr = self.memory.read_addrs(range(arr_start, arr_end, arr_entsize))
         if 'DT_INIT' in self._dynamic:
             self._init_func = self._dynamic['DT_INIT']
         if 'DT_INIT_ARRAY' in self._dynamic and 'DT_INIT_ARRAYSZ' in self._dynamic:
             arr_start = self._dynamic['DT_INIT_ARRAY']
             arr_end = arr_start + self._dynamic['DT_INIT_ARRAYSZ']
             arr_entsize = self.arch.bytes
-            self._init_arr = map(self.memory.read_addr_at, range(arr_start, arr_end, arr_entsize))
+            self._init_arr = self.memory.read_addrs(range(arr_start, arr_end, arr_entsize))
         if 'DT_FINI' in self._dynamic:
             self._fini_func = self._dynamic['DT_FINI']
         if 'DT_FINI_ARRAY' in self._dynamic and 'DT_FINI_ARRAYSZ' in self._dynamic:
             arr_start = self._dynamic['DT_FINI_ARRAY']
             arr_end = arr_start + self._dynamic['DT_FINI_ARRAYSZ']
             arr_entsize = self.arch.bytes
-            self._fini_arr = map(self.memory.read_addr_at, range(arr_start, arr_end, arr_entsize))
+            self._fini_arr = self.memory.read_addrs(range(arr_start, arr_end, arr_entsize))
         self._inits_extracted = True
 
 
@@ -326,15 +349,39 @@ class ELF(MetaELF):
     def _rebase_addr(self, addr):
         return addr + self.rebase_addr
 
+    @property
+    def _refers_to_file(self):
+        """
+        Whether the memory can refer back to ranges of the file. It can't for objects loaded from streams, or from
+        patched streams, whose patches have to show up in memory.
+        """
+        return self.binary is not None and type(self.binary_stream) is not PatchedStream
+
+    @property
+    def _maps_file(self):
+        """
+        Whether the contents of the file are mapped into memory.
+        """
+        return self.map_file and self._refers_to_file
+
     def _load_segment(self, seg):
         """
         Loads a segment based on a LOAD directive in the program header table.
         """
         self.segments.append(ELFSegment(seg))
-        seg_data = seg.data()
-        if seg.header.p_memsz > seg.header.p_filesz:
-            seg_data += '\0' * (seg.header.p_memsz - seg.header.p_filesz)
-        self.memory.add_backer(seg.header.p_vaddr, seg_data)
+        if self._maps_file:
+            # map the segment from the file instead of reading it, the bss part is left implicit
+            self.memory.add_backer(seg.header.p_vaddr,
+                                   FileBacker(self.binary, seg.header.p_offset, seg.header.p_filesz, seg.header.p_memsz))
+        else:
+            if seg.header.p_filesz:
+                data = seg.data()
+                if self._refers_to_file:
+                    data = FileString(data, self.binary, seg.header.p_offset)
+                self.memory.add_backer(seg.header.p_vaddr, data)
+            if seg.header.p_memsz > seg.header.p_filesz:
+                self.memory.add_backer(seg.header.p_vaddr + seg.header.p_filesz,
+                                       ZeroBacker(seg.header.p_memsz - seg.header.p_filesz))
 
     def __register_dyn(self, seg_readelf):
         """
@@ -355,7 +402,7 @@ class ELF(MetaELF):
             fakestrtabheader = {
                 'sh_offset': self._dynamic['DT_STRTAB']
             }
-            self.strtab = elffile.StringTableSection(fakestrtabheader, 'strtab_cle', self.memory)
+            self.strtab = elffile.StringTableSection(fakestrtabheader, 'strtab_cle', ClemoryStream(self.memory))
 
             # get the list of strings that are the required shared libraries
             self.deps = map(self.strtab.get_string, self.deps)
@@ -372,7 +419,7 @@ class ELF(MetaELF):
                     'sh_entsize': self._dynamic['DT_SYMENT'],
                     'sh_size': 0
                 } # bogus size: no iteration allowed
-                self.dynsym = elffile.SymbolTableSection(fakesymtabheader, 'symtab_cle', self.memory, self.reader, self.strtab)
+                self.dynsym = elffile.SymbolTableSection(fakesymtabheader, 'symtab_cle', ClemoryStream(self.memory), self.reader, self.strtab)
 
                 # set up the hash table, prefering the gnu hash section to the old hash section
                 # the hash table lets you get any symbol given its name
@@ -420,7 +467,7 @@ class ELF(MetaELF):
                         'sh_entsize': relentsz,
                         'sh_size': relsz
                     }
-                    readelf_relocsec = elffile.RelocationSection(fakerelheader, 'reloc_cle', self.memory, self.reader)
+                    readelf_relocsec = elffile.RelocationSection(fakerelheader, 'reloc_cle', ClemoryStream(self.memory), self.reader)
                     self.__register_relocs(readelf_relocsec)
 
                 # try to parse relocations out of a table of type DT_JMPREL
@@ -435,7 +482,7 @@ class ELF(MetaELF):
                         'sh_entsize': relentsz,
                         'sh_size': jmprelsz
                     }
-                    readelf_jmprelsec = elffile.RelocationSection(fakejmprelheader, 'jmprel_cle', self.memory, self.reader)
+                    readelf_jmprelsec = elffile.RelocationSection(fakejmprelheader, 'jmprel_cle', ClemoryStream(self.memory), self.reader)
                     self.jmprel = OrderedDict((reloc.symbol.name, reloc) for reloc in self.__register_relocs(readelf_jmprelsec) if reloc.symbol.name != '')
 
 
@@ -516,10 +563,16 @@ class ELF(MetaELF):
 
             if sec_readelf.header['sh_flags'] & 2:      # alloc flag - stick in memory maybe!
                 if sec_readelf.header['sh_addr'] not in self.memory:        # only allocate if not already allocated (i.e. by program header)
-                    if sec_readelf.header['sh_type'] == 'SH_NOBITS':
-                        self.memory.add_backer(sec_readelf.header['sh_addr'], '\0'*sec_readelf.header['sh_size'])
+                    if sec_readelf.header['sh_type'] == 'SHT_NOBITS':
+                        self.memory.add_backer(sec_readelf.header['sh_addr'], ZeroBacker(sec_readelf.header['sh_size']))
                     else: #elif sec_readelf.header['sh_type'] == 'SH_PROGBITS':
-                        self.memory.add_backer(sec_readelf.header['sh_addr'], sec_readelf.data())
+                        if self._maps_file:
+                            sec_data = FileBacker(self.binary, sec_readelf.header['sh_offset'], sec_readelf.header['sh_size'])
+                        elif self._refers_to_file:
+                            sec_data = FileString(sec_readelf.data(), self.binary, sec_readelf.header['sh_offset'])
+                        else:
+                            sec_data = sec_readelf.data()
+                        self.memory.add_backer(sec_readelf.header['sh_addr'], sec_data)
 
     def __register_section_symbols(self, sec_re):
         for sym_re in sec_re.iter_symbols():
@@ -576,19 +629,18 @@ class ELFHashTable(object):
 
     Information: http://docs.oracle.com/cd/E23824_01/html/819-0690/chapter6-48031.html
     """
-    def __init__(self, symtab, stream, offset, arch):
+    def __init__(self, symtab, memory, offset, arch):
         """
         :param symtab:  The symbol table to perform lookups from (as a pyelftools SymbolTableSection).
-        :param stream:  A file-like object to read from the ELF's memory.
+        :param memory:  The Clemory of the ELF file.
         :param offset:  The offset in the object where the table starts.
         :param arch:    The ArchInfo object for the ELF file.
         """
         self.symtab = symtab
-        fmt = '<' if arch.memory_endness == 'Iend_LE' else '>'
-        stream.seek(offset)
-        self.nbuckets, self.nchains = struct.unpack(fmt + 'II', stream.read(8))
-        self.buckets = struct.unpack(fmt + 'I'*self.nbuckets, stream.read(4*self.nbuckets))
-        self.chains = struct.unpack(fmt + 'I'*self.nchains, stream.read(4*self.nchains))
+        endness = arch.memory_endness
+        self.nbuckets, self.nchains = [int(x) for x in memory.read_array(offset, 2, 'I', endness)]
+        self.buckets = memory.read_array(offset + 8, self.nbuckets, 'I', endness)
+        self.chains = memory.read_array(offset + 8 + 4*self.nbuckets, self.nchains, 'I', endness)
 
     def get(self, k):
         """
@@ -597,12 +649,12 @@ class ELFHashTable(object):
         :param k:   The string to look up.
         """
         hval = self.elf_hash(k) % self.nbuckets
-        symndx = self.buckets[hval]
+        symndx = int(self.buckets[hval])
         while symndx != 0:
             sym = self.symtab.get_symbol(symndx)
             if sym.name == k:
                 return sym
-            symndx = self.chains[symndx]
+            symndx = int(self.chains[symndx])
         return None
 
     # from http://www.partow.net/programming/hashfunctions/
@@ -624,31 +676,53 @@ class GNUHashTable(object):
 
     Information: https://blogs.oracle.com/ali/entry/gnu_hash_elf_sections
     """
-    def __init__(self, symtab, stream, offset, arch):
+    def __init__(self, symtab, memory, offset, arch):
         """
         :param symtab:       The symbol table to perform lookups from (as a pyelftools SymbolTableSection).
-        :param stream:       A file-like object to read from the ELF's memory.
+        :param memory:       The Clemory of the ELF file.
         :param offset:       The offset in the object where the table starts.
         :param arch:         The ArchInfo object for the ELF file.
         """
         self.symtab = symtab
-        fmt = '<' if arch.memory_endness == 'Iend_LE' else '>'
+        endness = arch.memory_endness
         self.c = arch.bits
         fmtsz = 'I' if self.c == 32 else 'Q'
 
-        stream.seek(offset)
         self.nbuckets, self.symndx, self.maskwords, self.shift2 = \
-                struct.unpack(fmt + 'IIII', stream.read(16))
+                [int(x) for x in memory.read_array(offset, 4, 'I', endness)]
 
-        self.bloom = struct.unpack(fmt + fmtsz*self.maskwords, stream.read(self.c*self.maskwords/8))
-        self.buckets = struct.unpack(fmt + 'I'*self.nbuckets, stream.read(4*self.nbuckets))
+        offset += 16
+        self.bloom = memory.read_array(offset, self.maskwords, fmtsz, endness)
+        offset += self.c*self.maskwords/8
+        self.buckets = memory.read_array(offset, self.nbuckets, 'I', endness)
+        offset += 4*self.nbuckets
+        # the chain holds a hash value for each symbol from symndx on, with the low bit set on the last one of a bucket
+        self.chain = self._read_chain(memory, offset, endness)
+
+    def _read_chain(self, memory, offset, endness):
+        """
+        Read the whole chain. The table doesn't say how long it is, but it ends with the chain of the bucket with the
+        highest symbol index, so that one is walked to find its end. A chain cut short by the end of the memory is read
+        up to there.
+        """
+        last = max([int(x) for x in self.buckets] + [0]) - self.symndx
+        if last < 0:
+            return [ ]
+        size = last
+        try:
+            while not int(memory.read_array(offset + 4*size, 1, 'I', endness)[0]) & 1:
+                size += 1
+            size += 1
+        except KeyError:
+            pass
+        return memory.read_array(offset, size, 'I', endness)
 
     def _matches_bloom(self, H1):
         C = self.c
         H2 = H1 >> self.shift2
         N = ((H1 / C) & (self.maskwords - 1))
         BITMASK = (1 << (H1 % C)) | (1 << (H2 % C))
-        return (self.bloom[N] & BITMASK) == BITMASK
+        return (int(self.bloom[N]) & BITMASK) == BITMASK
 
     def get(self, k):
         """
@@ -659,20 +733,17 @@ class GNUHashTable(object):
         h = self.gnu_hash(k)
         if not self._matches_bloom(h):
             return None
-        n = self.buckets[h % self.nbuckets]
-        if n == 0:
+        n = int(self.buckets[h % self.nbuckets])
+        if n < self.symndx:
             return None
-        try:
-            sym = self.symtab.get_symbol(n)
-            while True:
+        for i in xrange(n - self.symndx, len(self.chain)):
+            chain_hash = int(self.chain[i])
+            if (chain_hash | 1) == (h | 1):
+                sym = self.symtab.get_symbol(i + self.symndx)
                 if sym.name == k:
                     return sym
-                n += 1
-                sym = self.symtab.get_symbol(n)
-                if (self.gnu_hash(sym.name) % self.nbuckets) != (h % self.nbuckets):
-                    break
-        except KeyError:
-            pass
+            if chain_hash & 1:
+                break
         return None
 
     @staticmethod
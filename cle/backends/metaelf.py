@@ -23,7 +23,7 @@ class MetaELF(Backend):
         thumb = self.arch.name.startswith("ARM") and addr % 2 == 1
         realaddr = addr
         if thumb: realaddr -= 1
-        dat = ''.join(self.memory.read_bytes(realaddr, 40))
+        dat = self.memory.read_bytes(realaddr, 40)
         return pyvex.IRSB(dat, addr, self.arch, bytes_offset=1 if thumb else 0)
 
     def _add_plt_stub(self, name, addr, sanity_check=True):
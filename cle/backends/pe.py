@@ -67,13 +67,13 @@ class WinReloc(Relocation):
                 # no work required
                 pass
             elif self.reloc_type == pefile.RELOCATION_TYPE['IMAGE_REL_BASED_HIGHLOW']:
-                org_bytes = ''.join(self.owner_obj.memory.read_bytes(self.addr, 4))
+                org_bytes = self.owner_obj.memory.read_bytes(self.addr, 4)
                 org_value = struct.unpack('<I', org_bytes)[0]
                 rebased_value = org_value + self.owner_obj.rebase_addr - self.owner_obj.requested_base
                 rebased_bytes = struct.pack('<I', rebased_value)
                 self.owner_obj.memory.write_bytes(self.dest_addr, rebased_bytes)
             elif self.reloc_type == pefile.RELOCATION_TYPE['IMAGE_REL_BASED_DIR64']:
-                org_bytes = ''.join(self.owner_obj.memory.read_bytes(self.addr, 8))
+                org_bytes = self.owner_obj.memory.read_bytes(self.addr, 8)
                 org_value = struct.unpack('<Q', org_bytes)[0]
                 rebased_value = org_value + self.owner_obj.rebase_addr - self.owner_obj.requested_base
                 rebased_bytes = struct.pack('<Q', rebased_value)
@@ -1,7 +1,8 @@
-from collections import namedtuple, defaultdict
+from collections import namedtuple
 import struct
 
 from . import Backend
+from ..memory import ZeroBacker
 
 # REFERENCES:
 # [1] https://www.uclibc.org/docs/tls.pdf
@@ -77,10 +78,10 @@ class TLSObj(Backend):
 
     def finalize(self):
         assert self.rebase_addr != 0
-        temp_dict = defaultdict(lambda: '\0')
+        # the TLS image is mostly zeros, only the pages written to below take up memory
+        self.memory.add_backer(0, ZeroBacker(TLS_ALLOC_SIZE))
         def drop(string, offset):
-            for i, c in enumerate(string):
-                temp_dict[i + offset] = c
+            self.memory.write_bytes(offset, string)
         def drop_int(num, offset):
             drop(struct.pack(self.arch.struct_fmt(), num), offset)
 
@@ -94,8 +95,8 @@ class TLSObj(Backend):
 
         # Write the init images from each of the modules' tdata sections
         for module in self.modules:
-            module.memory.seek(module.tls_tdata_start)
-            drop(module.memory.read(module.tls_tdata_size), self.tp_offset + module.tls_block_offset)
+            tdata = module.memory.read_bytes(module.tls_tdata_start, module.tls_tdata_size)
+            drop(tdata, self.tp_offset + module.tls_block_offset)
 
         # Set up the DTV
         # TODO: lmao capacity it's 2:30am please help me
@@ -107,8 +108,6 @@ class TLSObj(Backend):
             drop_int(1,
                      self.dtv_offset + (2*self.arch.bytes)*module.tls_module_id + self.arch.bytes)
 
-        self.memory.add_backer(0, ''.join(temp_dict[i] for i in xrange(0, TLS_ALLOC_SIZE)))
-
 
     @property
     def thread_pointer(self):
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+
+__all__ = ('BlockCachedStream',)
+
+class BlockCachedStream(object):
+    """
+    An object that wraps a readable stream, reading it a whole block at a time and keeping the most recently used blocks
+    around, so that the many small seeks and reads made while parsing a binary don't each turn into a read from the
+    underlying file.
+
+    Reads that would span more blocks than the cache can hold are passed straight through to the underlying stream.
+    The blocks are kept until :meth:`clear` is called, which backends do once they are done parsing.
+    """
+    def __init__(self, stream, block_size=0x10000, max_blocks=64):
+        """
+        :param stream:      The stream to wrap
+        :param block_size:  The size of the blocks read from the stream
+        :param max_blocks:  The number of blocks to keep cached
+        """
+        self.stream = stream
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict() # mapping from block number to its contents, least recently used first
+        self._pos = stream.tell()
+
+        # statistics: the number of reads made on this stream, and the number of blocks found in or read into the cache
+        self.reads = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        if name == 'stream':
+            raise AttributeError(name)
+        return getattr(self.stream, name)
+
+    @property
+    def stats(self):
+        """
+        A dict of the counters of this stream, including the number of reads from the underlying stream that the cache
+        saved.
+        """
+        return {'reads': self.reads, 'hits': self.hits, 'misses': self.misses,
+                'saved': max(self.reads - self.misses, 0)}
+
+    def _get_block(self, blockno):
+        block = self._blocks.pop(blockno, None)
+        if block is None:
+            self.misses += 1
+            self.stream.seek(blockno * self.block_size)
+            block = self.stream.read(self.block_size)
+            if len(self._blocks) >= self.max_blocks:
+                self._blocks.popitem(last=False)
+        else:
+            self.hits += 1
+        self._blocks[blockno] = block
+        return block
+
+    def read(self, n=-1):
+        self.reads += 1
+        if n is None or n < 0 or n > (self.max_blocks // 2) * self.block_size:
+            self.stream.seek(self._pos)
+            data = self.stream.read() if n is None or n < 0 else self.stream.read(n)
+            self._pos += len(data)
+            return data
+
+        pieces = [ ]
+        pos = self._pos
+        end = pos + n
+        while pos < end:
+            blockno, offset = divmod(pos, self.block_size)
+            block = self._get_block(blockno)
+            piece = block[offset:offset + end - pos]
+            if not piece:
+                break
+            pieces.append(piece)
+            pos += len(piece)
+            if len(block) < self.block_size:
+                break
+        self._pos = pos
+        return pieces[0] if len(pieces) == 1 else ''.join(pieces)
+
+    def readinto(self, buf):
+        """
+        Read into the writable buffer `buf`, as much as it can hold.
+
+        :return:    The number of bytes read.
+        """
+        self.reads += 1
+        view = memoryview(buf)
+        n = len(view)
+        if n > (self.max_blocks // 2) * self.block_size:
+            self.stream.seek(self._pos)
+            if hasattr(self.stream, 'readinto'):
+                size = self.stream.readinto(view)
+            else:
+                data = self.stream.read(n)
+                size = len(data)
+                view[:size] = data
+            self._pos += size
+            return size
+
+        # copy the slices of the cached blocks straight into buf
+        start = pos = self._pos
+        end = pos + n
+        while pos < end:
+            blockno, offset = divmod(pos, self.block_size)
+            block = self._get_block(blockno)
+            size = min(len(block) - offset, end - pos)
+            if size <= 0:
+                break
+            view[pos - start:pos - start + size] = memoryview(block)[offset:offset + size]
+            pos += size
+            if len(block) < self.block_size:
+                break
+        self._pos = pos
+        return pos - start
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            self.stream.seek(0, 2)
+            offset += self.stream.tell()
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def clear(self):
+        """
+        Drop all the cached blocks, for when the stream won't be read much any more.
+        """
+        self._blocks.clear()
+
+    def close(self):
+        self._blocks.clear()
+        return self.stream.close()
@@ -1,7 +1,11 @@
 import os
+import sys
 import logging
 import subprocess
 import struct
+import cPickle as pickle
+import multiprocessing
+from cStringIO import StringIO
 import elftools
 
 try:
@@ -33,6 +37,8 @@ class Loader(object):
     - custom_arch :         The archinfo.Arch object to use for the binary
     - custom_base_addr :    The address to rebase the object at
     - custom_entry_point :  The entry point to use for the object
+    - map_file :            Map ELF files into memory instead of reading them in. They must not be modified while loaded.
+                            The loader's `map_file` parameter sets this for every object that doesn't set it itself.
 
     More keys are defined on a per-backend basis.
     """
@@ -41,7 +47,8 @@ class Loader(object):
                  force_load_libs=None, skip_libs=None,
                  main_opts=None, lib_opts=None, custom_ld_path=None,
                  ignore_import_version_numbers=True, rebase_granularity=0x1000000,
-                 except_missing_libs=False, gdb_map=None, gdb_fix=False, aslr=False):
+                 except_missing_libs=False, gdb_map=None, gdb_fix=False, aslr=False, load_processes=None,
+                 cache_dir=None, share_objects=False, map_file=False):
         """
         :param main_binary:         The path to the main binary you're loading, or a file-like object with the binary
                                     in it.
@@ -65,6 +72,21 @@ class Loader(object):
         :param gdb_fix:             If `info sharedlibrary` was used, the addresses gdb gives us are in fact the
                                     addresses of the .text sections. We need to fix them to get the real load addresses.
         :param aslr                 Load libraries in symbolic address space.
+        :param load_processes:      The number of processes to parse shared libraries with. If this is more than
+                                    one, the dependencies are resolved breadth-first and the libraries of each level
+                                    are parsed in a pool of forked processes, which send the objects back pickled.
+                                    They are still added in the same order as when loading them one at a time, which
+                                    is the default. The objects parsed in the pool aren't put in the shared cache of
+                                    `share_objects`, but they are put in the cache in `cache_dir`.
+        :param cache_dir:           A directory in which to cache the objects this loader parses, so that loading them
+                                    again with the same options, from this or another process, can skip the parsing.
+        :param share_objects:       Share the objects this loader parses with the other loaders in this process that are
+                                    created with this option, so that each file is only parsed once. Every loader still
+                                    gets its own copy to rebase and relocate, but the copies share their memory until
+                                    they write to it.
+        :param map_file:            Map every ELF file this loader loads into memory instead of reading it in, unless
+                                    its options say otherwise, so that its pages are shared with every other loader
+                                    mapping the same file. The files must not be modified while they are loaded.
         """
 
         if hasattr(main_binary, 'seek') and hasattr(main_binary, 'read'):
@@ -82,6 +104,10 @@ class Loader(object):
         self._ignore_import_version_numbers = ignore_import_version_numbers
         self._rebase_granularity = rebase_granularity
         self._except_missing_libs = except_missing_libs
+        self._load_processes = load_processes
+        self._object_cache = ObjectCache(cache_dir) if cache_dir is not None else None
+        self._shared_cache = shared_object_cache if share_objects else None
+        self._map_file = map_file
         self._relocated_objects = set()
 
         self.aslr = aslr
@@ -91,6 +117,7 @@ class Loader(object):
         self.all_objects = []
         self.requested_objects = set()
         self.tls_object = None
+        self._memory_owners = {}    # mapping from the memory of each object to the object
         self._load_main_binary()
 
         if gdb_map is not None:
@@ -150,8 +177,10 @@ class Loader(object):
         self.main_bin = self.load_object(self._main_binary_path
                                             if self._main_binary_stream is None
                                             else self._main_binary_stream,
-                                        self._main_opts,
-                                        is_main_bin=True)
+                                        self._object_options(self._main_opts),
+                                        is_main_bin=True,
+                                        cache=self._object_cache,
+                                        shared_cache=self._shared_cache)
         self.memory = Clemory(self.main_bin.arch, root=True)
         base_addr = self._main_opts.get('custom_base_addr', None)
         if base_addr is None and self.main_bin.requested_base is not None:
@@ -165,49 +194,118 @@ class Loader(object):
         self.add_object(self.main_bin, base_addr)
 
     def _load_dependencies(self):
+        if self._load_processes is not None and self._load_processes > 1 and hasattr(os, 'fork'):
+            self._load_dependencies_parallel()
+            return
+
         while len(self._unsatisfied_deps) > 0:
             dep = self._unsatisfied_deps.pop(0)
-            options = {}
-            if isinstance(dep, (str, unicode)):
-                if os.path.basename(dep) in self._satisfied_deps:
-                    continue
-                if self._ignore_import_version_numbers and dep.strip('.0123456789') in self._satisfied_deps:
-                    continue
-
-                path = self._get_lib_path(dep)
+            if self._dep_satisfied(dep):
+                continue
+            loaded = self._load_dependency(dep)
+            if loaded is not None:
+                self.add_object(*loaded)
 
-                for path in self._possible_paths(dep):
-                    libname = os.path.basename(path)
-                    if self.identify_object(path) == 'elf':
-                        soname = self._extract_soname(path)
-                    else:
-                        soname = libname
-
-                    if libname in self._lib_opts.keys():
-                        options = dict(self._lib_opts[libname])
-                    elif soname in self._lib_opts.keys():
-                        options = dict(self._lib_opts[soname])
-
-                    try:
-                        options['aslr'] = self.aslr
-                        obj = self.load_object(path, options, compatible_with=self.main_bin)
-                        break
-                    except (CLECompatibilityError, CLEFileNotFoundError):
+    def _load_dependencies_parallel(self):
+        """
+        Load the dependencies a level of the dependency graph at a time, parsing the libraries of each level in a
+        process pool. The objects are added in the order of the queue, exactly as `_load_dependencies` would, and any
+        library that turns out to be satisfied by an object added before it is thrown away.
+        """
+        pool = multiprocessing.Pool(self._load_processes, _init_load_worker, (self,))
+        try:
+            while len(self._unsatisfied_deps) > 0:
+                level, self._unsatisfied_deps = self._unsatisfied_deps, []
+
+                pending = {}
+                for dep in level:
+                    if isinstance(dep, (str, unicode)) and dep not in pending and not self._dep_satisfied(dep):
+                        pending[dep] = pool.apply_async(_load_dependency_in_worker, (dep,))
+
+                for dep in level:
+                    result = pending.pop(dep, None) if isinstance(dep, (str, unicode)) else None
+                    if self._dep_satisfied(dep):
+                        if result is not None:
+                            result.wait()
                         continue
+                    if result is None:
+                        loaded = self._load_dependency(dep)
+                    else:
+                        loaded = result.get()
+                        if loaded is not None:
+                            data, base_addr = loaded
+                            if data is None:
+                                # the worker couldn't pickle it, so parse it here instead
+                                loaded = self._load_dependency(dep)
+                            else:
+                                unpickler = pickle.Unpickler(StringIO(data))
+                                unpickler.persistent_load = lambda pid: self.main_bin
+                                loaded = unpickler.load(), base_addr
+                    if loaded is not None:
+                        self.add_object(*loaded)
+        finally:
+            pool.terminate()
+
+    def _object_options(self, options):
+        """
+        Add the options set for every object by the loader to the options for loading one object.
+        """
+        if self._map_file and 'map_file' not in options:
+            options = dict(options, map_file=True)
+        return options
+
+    def _dep_satisfied(self, dep):
+        """
+        Whether the dependency `dep` is already provided by a loaded object, or was asked to be skipped.
+        """
+        if not isinstance(dep, (str, unicode)):
+            return False
+        if os.path.basename(dep) in self._satisfied_deps:
+            return True
+        return self._ignore_import_version_numbers and dep.strip('.0123456789') in self._satisfied_deps
+
+    def _load_dependency(self, dep):
+        """
+        Find and parse the library for the dependency `dep`, without adding it to the memory map.
+
+        :param dep:     The name or path of a library, or an already loaded backend object
+        :return:        A tuple of the object and the base address to load it at, or None if it couldn't be found.
+        """
+        options = {}
+        if isinstance(dep, (str, unicode)):
+            for path in self._possible_paths(dep):
+                libname = os.path.basename(path)
+                if self.identify_object(path) == 'elf':
+                    soname = self._extract_soname(path)
                 else:
-                    if self._except_missing_libs:
-                        raise CLEFileNotFoundError("Could not find shared library: %s" % dep)
+                    soname = libname
+
+                if libname in self._lib_opts.keys():
+                    options = dict(self._lib_opts[libname])
+                elif soname in self._lib_opts.keys():
+                    options = dict(self._lib_opts[soname])
+
+                try:
+                    options['aslr'] = self.aslr
+                    options = self._object_options(options)
+                    obj = self.load_object(path, options, compatible_with=self.main_bin,
+                                           cache=self._object_cache, shared_cache=self._shared_cache)
+                    break
+                except (CLECompatibilityError, CLEFileNotFoundError):
                     continue
-            elif isinstance(dep, Backend):
-                obj = dep
             else:
-                raise CLEError("Bad library: %s" % path)
+                if self._except_missing_libs:
+                    raise CLEFileNotFoundError("Could not find shared library: %s" % dep)
+                return None
+        elif isinstance(dep, Backend):
+            obj = dep
+        else:
+            raise CLEError("Bad library: %s" % dep)
 
-            base_addr = options.get('custom_base_addr', None)
-            self.add_object(obj, base_addr)
+        return obj, options.get('custom_base_addr', None)
 
     @staticmethod
-    def load_object(path, options=None, compatible_with=None, is_main_bin=False):
+    def load_object(path, options=None, compatible_with=None, is_main_bin=False, cache=None, shared_cache=None):
         """
         Load a file with some backend. Try to identify the type of the file to autodetect which backend to use.
 
@@ -221,6 +319,10 @@ class Loader(object):
                                     This method will throw a :class:`CLECompatibilityError <cle.errors.CLECompatibilityError>`
                                     if the file at the given path is not compatibile with this parameter.
         :param bool is_main_bin:    Whether this file is the main executable of whatever process we are loading
+        :param cache:               An :class:`ObjectCache <cle.object_cache.ObjectCache>` to look the object up in
+                                    before parsing the file, and to store it in afterwards.
+        :param shared_cache:        A :class:`SharedObjectCache <cle.object_cache.SharedObjectCache>` to use the same
+                                    way. It is looked in before `cache`.
         """
         # Try to find the filetype of the object. Also detect if you were given a bad filepath
         if options is None:
@@ -261,9 +363,25 @@ class Loader(object):
         if len(backends) == 0:
             raise CLECompatibilityError('No compatible backends specified for filetype %s (file %s)' % (filetype, path))
 
+        # caches that don't have the object get it stored in them once it's found in a later one or parsed
+        missed = [ ]
+        if isinstance(path, (str, unicode)):
+            for c in (shared_cache, cache):
+                if c is None:
+                    continue
+                key = c.key(path, options, is_main_bin)
+                loaded = c.load(key, compatible_with)
+                if loaded is not None:
+                    for missed_cache, missed_key in missed:
+                        missed_cache.store(missed_key, loaded, compatible_with)
+                    return loaded
+                missed.append((c, key))
+
         for backend in backends:
             try:
                 loaded = backend(path, compatible_with=compatible_with, filetype=filetype, is_main_bin=is_main_bin, **options)
+                for missed_cache, missed_key in missed:
+                    missed_cache.store(missed_key, loaded, compatible_with)
                 return loaded
             except CLECompatibilityError:
                 raise
@@ -295,7 +413,7 @@ class Loader(object):
             stream = path
             plsclose = False
         else:
-            stream = open(path, 'rb')
+            stream = BlockCachedStream(open(path, 'rb'))
             plsclose = True
 
         identstring = stream.read(0x1000)
@@ -347,8 +465,27 @@ class Loader(object):
 
         l.info("[Rebasing %s @%#x]", obj.binary, base_addr)
         self.memory.add_backer(base_addr, obj.memory)
+        self._memory_owners[obj.memory] = obj
         obj.rebase_addr = base_addr
 
+        for region in obj.segments if obj.segments else obj.sections:
+            perms = self._region_permissions(region)
+            if perms is not None and region.memsize and getattr(region, 'occupies_memory', True):
+                self.memory.set_permissions(base_addr + region.vaddr, base_addr + region.vaddr + region.memsize, perms)
+
+    @staticmethod
+    def _region_permissions(region):
+        """
+        Get the permissions of a segment or section as Clemory permission flags, or None if the backend doesn't know
+        them.
+        """
+        try:
+            return (PERM_READ if region.is_readable else 0) | \
+                   (PERM_WRITE if region.is_writable else 0) | \
+                   (PERM_EXEC if region.is_executable else 0)
+        except (AttributeError, NotImplementedError):
+            return None
+
     def _possible_paths(self, path):
         if os.path.exists(path): yield path
         dirs = []                   # if we say dirs = blah, we modify the original
@@ -386,9 +523,20 @@ class Loader(object):
             self._perform_reloc(dep_obj)
 
         if isinstance(obj, (MetaELF, PE)):
+            solist = ([self.main_bin] if self.main_bin is not obj else []) + dep_objs + [obj]
+            writes = [ ]
             for reloc in obj.relocs:
-                if not reloc.resolved:
-                    reloc.relocate(([self.main_bin] if self.main_bin is not obj else []) + dep_objs + [obj])
+                if reloc.resolved:
+                    continue
+                if reloc.batchable:
+                    if reloc.resolve_symbol(solist):
+                        writes.append((reloc.dest_addr, reloc.value))
+                else:
+                    # the other relocations may read what was written before them
+                    obj.memory.write_addrs(writes)
+                    writes = [ ]
+                    reloc.relocate(solist)
+            obj.memory.write_addrs(writes)
 
     def provide_symbol(self, owner, name, offset, size=0, binding='STB_GLOBAL', st_type='STT_FUNC', st_info='CLE'):
         newsymbol = Symbol(owner, name, offset, size, binding, st_type, st_info)
@@ -435,21 +583,16 @@ class Loader(object):
             self.tls_object.finalize()
 
     def addr_belongs_to_object(self, addr):
-        for obj in self.all_objects:
-            if not (addr >= obj.get_min_addr() and addr < obj.get_max_addr()):
-                continue
-
-            if isinstance(obj.memory, str):
-                return obj
-
-            elif isinstance(obj.memory, Clemory):
-                if addr - obj.rebase_addr in obj.memory:
-                    return obj
-
-            else:
-                raise CLEError('Unsupported memory type %s' % type(obj.memory))
-
-        return None
+        """
+        Return the object whose memory holds `addr`, or None. This is a single lookup in the flattened address map of
+        the loader's memory.
+        """
+        if self.memory is None:
+            return None
+        leaf = self.memory._find_leaf(addr)
+        if leaf is None:
+            return None
+        return self._memory_owners.get(leaf[2])
 
     def whats_at(self, addr):
         """
@@ -737,7 +880,7 @@ class Loader(object):
             raise CLEError("Path %s does not exist" % path)
 
         with open(path, 'rb') as f:
-            e = elftools.elf.elffile.ELFFile(f)
+            e = elftools.elf.elffile.ELFFile(BlockCachedStream(f))
             return e.get_section_by_name(".text").header.sh_offset
 
     @staticmethod
@@ -750,7 +893,7 @@ class Loader(object):
 
         with open(path, 'rb') as f:
             try:
-                e = elftools.elf.elffile.ELFFile(f)
+                e = elftools.elf.elffile.ELFFile(BlockCachedStream(f))
                 dyn = e.get_section_by_name('.dynamic')
                 soname = [ x.soname for x in list(dyn.iter_tags()) if x.entry.d_tag == 'DT_SONAME']
                 if not soname:
@@ -801,13 +944,82 @@ class Loader(object):
     def all_elf_objects(self):
         return [o for o in self.all_objects if isinstance(o, MetaELF)]
 
+    def footprint(self):
+        """
+        Account for the memory held by the loaded objects. This is cheap enough to call regularly: it takes time in
+        the number of backers, symbols and relocations, not in the amount of data loaded.
+
+        :return:    A dict with the :func:`Clemory.footprint` of the whole address space under `memory`, and under
+                    `objects` a list with a dict for each object. These hold its `name`, the `backers`, `mapped`
+                    and `updates` byte counts of its memory, and the shallow size in bytes of its Python `symbols`
+                    and `relocations` objects. The symbols of an object shared with other loaders (see
+                    `share_objects`) are only counted once they are bound to its copy in this loader.
+        """
+        objects = [ ]
+        for obj in self.all_objects:
+            memory = obj.memory.footprint() if obj.memory is not None else { }
+            symbols = { }
+            for table in (obj._symbol_cache, obj.symbols_by_addr):
+                # the symbols of a shared object that weren't bound to this copy belong to the cache
+                values = table.bound_values() if isinstance(table, _BoundSymbols) else table.itervalues()
+                symbols.update((id(sym), sym) for sym in values)
+            objects.append({
+                'name': obj.provides or obj.binary or repr(obj),
+                'backers': memory.get('backers', 0),
+                'mapped': memory.get('mapped', 0),
+                'updates': memory.get('updates', 0),
+                'symbols': self._python_size(symbols.itervalues()),
+                'relocations': self._python_size(obj.relocs),
+            })
+        return {'memory': self.memory.footprint(), 'objects': objects}
+
+    @staticmethod
+    def _python_size(things):
+        """
+        Sum up the shallow sizes of some Python objects and of their attribute dicts.
+        """
+        return sum(sys.getsizeof(x) + (sys.getsizeof(x.__dict__) if hasattr(x, '__dict__') else 0) for x in things)
+
     def perform_irelative_relocs(self, resolver_func):
         for obj in self.all_objects:
+            writes = [ ]
             for resolver, dest in obj.irelatives:
                 val = resolver_func(resolver)
                 if val is not None:
-                    obj.memory.write_addr_at(dest, val)
+                    writes.append((dest, val))
+            obj.memory.write_addrs(writes)
+
+_worker_loader = None
+
+def _init_load_worker(loader):
+    global _worker_loader # pylint: disable=global-statement
+    _worker_loader = loader
+
+def _load_dependency_in_worker(dep):
+    """
+    Find and parse a library in a worker process of `Loader._load_dependencies_parallel`.
+
+    :return:    None if the library couldn't be found, or a tuple of the pickled object, or None if it can't be pickled,
+                and the base address to load it at.
+    """
+    loaded = _worker_loader._load_dependency(dep) # pylint: disable=protected-access
+    if loaded is None:
+        return None
+    obj, base_addr = loaded
+    f = StringIO()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = lambda x: 'main_bin' if x is _worker_loader.main_bin else None
+    try:
+        pickler.dump(obj)
+        data = f.getvalue()
+    except Exception as e: # pylint: disable=broad-except
+        l.debug("Can't send %s back from the worker: %s", obj.binary, e)
+        data = None
+    obj.close()
+    return data, base_addr
 
 from .errors import CLEError, CLEOperationError, CLEFileNotFoundError, CLECompatibilityError
-from .memory import Clemory
+from .memory import Clemory, PERM_READ, PERM_WRITE, PERM_EXEC
+from .cached_stream import BlockCachedStream
+from .object_cache import ObjectCache, shared_object_cache, _BoundSymbols
 from .backends import IDABin, MetaELF, ELF, PE, ALL_BACKENDS, Backend, Symbol, TLSObj
@@ -1,214 +1,1331 @@
+import os
+import re
+import sys
+import mmap
+import array
 import bisect
 import struct
+import weakref
 import cffi
+import hashlib
 
-__all__ = ('Clemory',)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .errors import CLEError
+
+__all__ = ('Clemory', 'ClemoryStream', 'FileBacker', 'FileString', 'ZeroBacker', 'PERM_READ', 'PERM_WRITE', 'PERM_EXEC')
+
+_ffi = cffi.FFI()
+
+_structs = { }
+
+def _get_struct(fmt):
+    """
+    Get a precompiled struct.Struct for the format string `fmt`. Only meant for the handful of fixed formats used
+    over and over, since the structs are kept forever: formats for a variable number of items should use a repeat
+    count and go through the struct module functions instead.
+    """
+    s = _structs.get(fmt)
+    if s is None:
+        s = _structs[fmt] = struct.Struct(fmt)
+    return s
+
+# array.array typecodes for each struct format character, picked by item size since those vary between platforms
+_array_typecodes = { }
+for _tc in 'bBhHiIlL':
+    _array_typecodes.setdefault((array.array(_tc).itemsize, _tc.islower()), _tc)
+_array_typecodes = dict((_fc, _array_typecodes.get((struct.calcsize('=' + _fc), _fc.islower())))
+                        for _fc in 'bBhHiIlLqQ')
+del _tc
+
+# permission flags for Clemory.set_permissions, with the same values as the ELF segment flags
+PERM_READ = 4
+PERM_WRITE = 2
+PERM_EXEC = 1
+
+# granularity of the copy-on-write pages updates are stored in
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_MASK = PAGE_SIZE - 1
+
+# how much memory is read at a time when searching for fixed-length patterns
+FIND_CHUNK_SIZE = 0x100000
+
+# how many written ranges are recorded for refreshing the flattened copy before they are merged together
+DIRTY_RANGES_LIMIT = 0x400
+
+class _FileMapping(object):
+    """
+    A whole file mapped read-only into memory, shared between all the FileBackers for that file.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        # mmap objects don't export buffers that memoryviews can be made from, but read-only buffer objects over them do
+        self.view = memoryview(buffer(self.mmap)) if self.size else memoryview('')
+
+_file_mappings = weakref.WeakValueDictionary()
+
+def _file_key(path):
+    """
+    Identify the current version of the file at `path`, which changes whenever the file is written to or replaced.
+    """
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+def _map_file(key):
+    mapping = _file_mappings.get(key)
+    if mapping is None:
+        mapping = _FileMapping(key[0])
+        _file_mappings[key] = mapping
+    return mapping
+
+
+class FileBacker(object):
+    """
+    A backer for a range of a file. Instead of being read into a string, the file is mapped into memory, so its pages
+    are only read in when they are first accessed, and are shared with every other backer for the same file. If
+    `memsize` is larger than `filesize`, the rest of the backer reads as zeros without being stored anywhere, like the
+    bss part of a segment.
+
+    Slicing or indexing a FileBacker returns a string, so it can be used anywhere a string backer can.
+
+    The file is mapped when the backer is first used, and it must not have changed since the backer was made, or a
+    CLEError is raised. Changes made to the file once it is mapped can't be detected, and show through the unwritten
+    parts of the backer, so only files that won't change while they are loaded should be mapped.
+
+    When pickled, a FileBacker only stores the range of the file it refers to and a hash of its contents. The file is
+    mapped again when the unpickled backer is first used, and checked against the hash then.
+    """
+    def __init__(self, path, offset, filesize, memsize=None):
+        """
+        :param path:        The path to the file.
+        :param offset:      The offset in the file where the backer starts.
+        :param filesize:    The number of bytes to take from the file.
+        :param memsize:     The total size of the backer, if it is larger than `filesize`.
+        """
+        self.path = path
+        self.offset = offset
+        self.filesize = filesize
+        self.memsize = filesize if memsize is None else max(memsize, filesize)
+        self._mapping = None
+        self._file_key = _file_key(path)
+        self._digest = None
+        self._check_digest = False
+
+    def __len__(self):
+        return self.memsize
+
+    def __repr__(self):
+        return '<FileBacker %s [%#x:%#x], size %#x>' % (self.path, self.offset, self.offset + self.filesize, self.memsize)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_mapping'] = None
+        state['_file_key'] = None   # the hash is checked instead, the file may have been copied or touched since
+        state['_digest'] = self.digest
+        state['_check_digest'] = True
+        return state
+
+    def __setstate__(self, state):
+        self._file_key = None
+        self._digest = None
+        self._check_digest = False
+        self.__dict__.update(state)
+
+    @property
+    def mapping(self):
+        if self._mapping is None:
+            key = _file_key(self.path)
+            if self._file_key is not None and key != self._file_key:
+                raise CLEError("%s changed since it was loaded" % self.path)
+            mapping = _map_file(key)
+            if self._check_digest:
+                if self._hash(mapping) != self._digest:
+                    raise CLEError("%s changed since this backer for it was pickled" % self.path)
+                self._check_digest = False
+            self._mapping = mapping
+        return self._mapping
+
+    @property
+    def digest(self):
+        """
+        The SHA-1 hex digest of the part of the file this backer refers to.
+        """
+        if self._digest is None:
+            self._digest = self._hash(self.mapping)
+        return self._digest
+
+    def _hash(self, mapping):
+        return hashlib.sha1(mapping.view[self.offset:self.offset + self.filesize]).hexdigest()
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            lo, hi, step = k.indices(self.memsize)
+            if step != 1:
+                raise ValueError("FileBacker slices can't have a step")
+            if hi <= lo:
+                return ''
+            out = self.mapping.mmap[self.offset + lo:self.offset + min(hi, self.filesize)] if lo < self.filesize else ''
+            return out + '\0' * (hi - lo - len(out))
+        if k < 0:
+            k += self.memsize
+        if not 0 <= k < self.memsize:
+            raise IndexError(k)
+        return self[k:k+1]
+
+    def _slice(self, lo, hi):
+        """
+        Make a backer for the part of this one between `lo` and `hi`, sharing its mapping.
+        """
+        mapping = self.mapping # checks the file before the hash of the whole backer is dropped
+        out = FileBacker.__new__(FileBacker)
+        out.__dict__.update(self.__dict__)
+        out._mapping = mapping
+        out.offset = self.offset + lo
+        out.filesize = max(min(hi, self.filesize) - lo, 0)
+        out.memsize = hi - lo
+        out._digest = None
+        return out
+
+    def buffer(self, lo, hi):
+        """
+        Return a read-only buffer object over the bytes between `lo` and `hi` without copying them, or None if the range
+        reaches into the zero-filled part of the backer.
+        """
+        if hi > self.filesize or self.offset + hi > self.mapping.size:
+            return None
+        return buffer(self.mapping.mmap, self.offset + lo, hi - lo)
+
+    def view(self, lo, hi):
+        """
+        Like :func:`buffer`, but return a memoryview.
+        """
+        buf = self.buffer(lo, hi)
+        return memoryview(buf) if buf is not None else None
+
+
+class FileString(str):
+    """
+    A string read in from a range of a file, which can be used as a backer like any other string. When pickled, it only
+    stores the range of the file it was read from and a hash of its contents, like a :class:`FileBacker` does. The range
+    is read in again when it is unpickled, and a CLEError is raised if it doesn't match the hash any more.
+    """
+    def __new__(cls, data, path, offset):
+        """
+        :param data:    The contents of the range.
+        :param path:    The path to the file.
+        :param offset:  The offset in the file where the range starts.
+        """
+        self = super(FileString, cls).__new__(cls, data)
+        self.path = path
+        self.offset = offset
+        self._digest = None
+        return self
+
+    @property
+    def digest(self):
+        """
+        The SHA-1 hex digest of the string.
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha1(self).hexdigest()
+        return self._digest
+
+    def __reduce__(self):
+        return _read_file_string, (self.path, self.offset, len(self), self.digest)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+def _read_file_string(path, offset, size, digest):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+    except IOError as e:
+        raise CLEError("Can't read %s: %s" % (path, e))
+    if len(data) != size or hashlib.sha1(data).hexdigest() != digest:
+        raise CLEError("%s changed since this string from it was pickled" % path)
+    out = FileString(data, path, offset)
+    out._digest = digest
+    return out
+
+
+class ZeroBacker(object):
+    """
+    A backer of zeros, like a bss section, which takes no memory however large it is. Writes to it go to the update
+    pages, or with :func:`Clemory.write_bytes_to_backer` to bytearray backers split out of it, so only the pages written
+    to ever take up memory.
+    """
+    def __init__(self, size):
+        """
+        :param size:    The size of the backer.
+        """
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return '<ZeroBacker, size %#x>' % self.size
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            lo, hi, step = k.indices(self.size)
+            if step != 1:
+                raise ValueError("ZeroBacker slices can't have a step")
+            return '\0' * max(hi - lo, 0)
+        if k < 0:
+            k += self.size
+        if not 0 <= k < self.size:
+            raise IndexError(k)
+        return '\0'
+
+    def _slice(self, lo, hi): # pylint: disable=no-self-use
+        return ZeroBacker(hi - lo)
+
+    def buffer(self, lo, hi):
+        """
+        Return a read-only buffer object over the zeros between `lo` and `hi`, or None if the range is larger than a page.
+        """
+        if hi - lo > PAGE_SIZE:
+            return None
+        return buffer(_zero_page, 0, hi - lo)
+
+    def view(self, lo, hi):
+        """
+        Like :func:`buffer`, but return a memoryview.
+        """
+        buf = self.buffer(lo, hi)
+        return memoryview(buf) if buf is not None else None
+
+_zero_page = '\0' * PAGE_SIZE
 
-# TODO: Further optimization is possible now that the list of backers is sorted
 
 class Clemory(object):
     """
     An object representing a memory space. Uses "backers" and "updates" to separate the concepts of loaded and written
     memory and make lookups more efficient.
 
+    Updates are stored as copy-on-write pages of PAGE_SIZE bytes: the first write to a page copies the backed data of
+    that page into a bytearray, which then shadows the backers. Writes to addresses backed by a nested Clemory are
+    passed on to it, so the pages of a Clemory only ever shadow its own string and file backers.
+
     Accesses can be made with [index] notation.
     """
     def __init__(self, arch, root=False):
         self._arch = arch
         self._backers = []  # tuple of (start, str)
-        self._updates = {}
+        self._updates = {}  # mapping from page number to bytearray of the page
+        self._owned_pages = set() # numbers of the update pages not shared with any fork, which can be written in place
+        self._owned_backers = set() # starts of the bytearray backers not shared with any fork or caller
         self._pointer = 0
         self._root = root
 
+        # index over self._backers, rebuilt lazily whenever the backer layout changes. _backer_starts holds the start
+        # address of each backer, _backer_ends holds the running maximum of the end addresses of the backers up to and
+        # including each index, so both lists are sorted and can be bisected.
+        self._backer_starts = [ ]
+        self._backer_ends = [ ]
+        self._index_dirty = False
+        # flattened translation table from addresses to the string and file backers holding them however deeply they
+        # are nested, as sorted, non-overlapping tuples of (start, end, owning Clemory, address of the owning Clemory,
+        # start of the backer, data). Built lazily, None when out of date.
+        self._leaves = None
+        self._leaf_starts = [ ]
+        self._parents = weakref.WeakKeyDictionary() # mapping from the Clemorys this one is a backer of to its start there
+
         self._cbackers = [ ] # tuple of (start, cdata<buffer>)
-        self._needs_flattening_personal = True
+        self._cbacker_starts = [ ]
+        # for each cbacker, a list of the backers it was made from, as tuples of (offset in the cbacker, owning
+        # Clemory, start in the owning Clemory, data)
+        self._cbacker_sources = [ ]
+        self._needs_flattening_personal = True  # the layout of the backers changed, all strides have to be checked
+        self._dirty_ranges = [ ] # tuples of (start, end) written to since the last flattening, only kept on the root
+        self._dirty_ranges_limit = DIRTY_RANGES_LIMIT # length of _dirty_ranges at which it is merged
+
+        # the ranges changed since the oldest live checkpoint, as (start, end) tuples, and for each checkpoint token the
+        # length the journal had when it was taken and what is needed to roll back to it. See :func:`checkpoint`.
+        self._journal = [ ]
+        self._journal_limit = DIRTY_RANGES_LIMIT # number of entries after the newest checkpoint at which they are merged
+        self._checkpoints = { }
+        self._next_checkpoint = 0
+
+        # the permission map, as sorted, non-overlapping tuples of (start, end, permissions). See :func:`set_permissions`.
+        self._permissions = [ ]
+        self._permission_starts = [ ]
 
     def add_backer(self, start, data):
         """
         Adds a backer to the memory.
 
         :param start:   The address where the backer should be loaded.
-        :param data:    The backer itself. Can be either a string or another :class:`Clemory`.
+        :param data:    The backer itself. Can be either a string, a bytearray, a :class:`FileBacker`, a
+                        :class:`ZeroBacker` or another :class:`Clemory`.
         """
-        if not isinstance(data, (str, Clemory)):
-            raise TypeError("Data must be a string or a Clemory")
+        if not isinstance(data, (str, bytearray, FileBacker, ZeroBacker, Clemory)):
+            raise TypeError("Data must be a string, a bytearray, a FileBacker, a ZeroBacker or a Clemory")
         if start in self:
             raise ValueError("Address %#x is already backed!" % start)
         if isinstance(data, Clemory) and data._root:
             raise ValueError("Cannot add a root clemory as a backer!")
         bisect.insort(self._backers, (start, data))
-        self._needs_flattening_personal = True
+        if isinstance(data, Clemory):
+            data._parents[self] = start
+        self._invalidate_index()
+        self._journal_backer(start, data)
+        if not isinstance(data, Clemory):
+            self._refresh_pages(start, start + len(data))
 
     def update_backer(self, start, data):
-        if not isinstance(data, (str, Clemory)):
-            raise TypeError("Data must be a string or a Clemory")
-        for i, (oldstart, _) in enumerate(self._backers):
+        if not isinstance(data, (str, bytearray, FileBacker, ZeroBacker, Clemory)):
+            raise TypeError("Data must be a string, a bytearray, a FileBacker, a ZeroBacker or a Clemory")
+        for i, (oldstart, olddata) in enumerate(self._backers):
             if oldstart == start:
+                self._owned_backers.discard(start)
+                if isinstance(olddata, Clemory):
+                    olddata._parents.pop(self, None)
+                if isinstance(data, Clemory):
+                    data._parents[self] = start
                 self._backers[i] = (start, data)
-                self._needs_flattening_personal = True
+                self._invalidate_index()
+                self._journal_backer(start, olddata)
+                self._journal_backer(start, data)
+                if not isinstance(data, Clemory):
+                    # the new data replaces whatever was written over the old one
+                    self._refresh_pages(start, start + len(data))
                 break
         else:
             raise ValueError("Can't find backer to update")
 
     def remove_backer(self, start):
-        for i, (oldstart, _) in enumerate(self._backers):
+        for i, (oldstart, olddata) in enumerate(self._backers):
             if oldstart == start:
+                if isinstance(olddata, Clemory):
+                    olddata._parents.pop(self, None)
+                self._owned_backers.discard(start)
                 self._backers.pop(i)
-                self._needs_flattening_personal = True
+                self._invalidate_index()
+                self._journal_backer(start, olddata)
                 break
         else:
             raise ValueError("Can't find backer to remove")
 
-    def __iter__(self):
-        for start, string in self._backers:
-            if isinstance(string, str):
-                for x in xrange(len(string)):
-                    yield start + x
+    def _invalidate_index(self):
+        """
+        Mark the backer index and the flattened strides of this memory, and of every memory using it as a backer, as
+        out of date.
+        """
+        self._index_dirty = True
+        self._leaves = None
+        self._needs_flattening_personal = True
+        for parent in self._parents.keys():
+            parent._invalidate_index()
+
+    def _mark_dirty(self, lo, hi):
+        """
+        Record that the contents between addresses `lo` and `hi` were written to, so that the root memory can refresh
+        its flattened copy of them.
+        """
+        if self._root and self._cbackers:
+            self._add_dirty_range(lo, hi)
+        if self._checkpoints:
+            self._journal_range(lo, hi)
+        for parent, start in self._parents.items():
+            parent._mark_dirty(lo + start, hi + start)
+
+    def _add_dirty_range(self, lo, hi):
+        """
+        Add a written range to the ones the flattened copy has to be refreshed for, merging it into the last one if they
+        touch, and merging the whole list once it gets long, so that it stays small however many writes are made
+        between flattenings.
+        """
+        if self._dirty_ranges:
+            last_lo, last_hi = self._dirty_ranges[-1]
+            if lo <= last_hi and hi >= last_lo:
+                self._dirty_ranges[-1] = (min(lo, last_lo), max(hi, last_hi))
+                return
+        self._dirty_ranges.append((lo, hi))
+        if len(self._dirty_ranges) > self._dirty_ranges_limit:
+            self._dirty_ranges = self._merge_ranges(self._dirty_ranges)
+            # scattered writes don't merge, so make sure there's room for as many again before the next merge
+            self._dirty_ranges_limit = max(DIRTY_RANGES_LIMIT, 2 * len(self._dirty_ranges))
+
+    def _journal_range(self, lo, hi):
+        """
+        Add a changed range to the journal, merging it into the last entry if that is newer than every checkpoint. Like
+        :func:`_add_dirty_range`, the entries newer than every checkpoint are merged together once there are many of
+        them, so the journal stays small however many writes are made between checkpoints.
+        """
+        newest = max(index for index, _ in self._checkpoints.itervalues())
+        if len(self._journal) > newest:
+            last_lo, last_hi = self._journal[-1]
+            if lo <= last_hi and hi >= last_lo:
+                self._journal[-1] = (min(lo, last_lo), max(hi, last_hi))
+                return
+        self._journal.append((lo, hi))
+        if len(self._journal) - newest > self._journal_limit:
+            self._journal[newest:] = self._merge_ranges(self._journal[newest:])
+            self._journal_limit = max(DIRTY_RANGES_LIMIT, 2 * (len(self._journal) - newest))
+
+    def _journal_change(self, lo, hi):
+        """
+        Record in the journals of this memory and the memories using it as a backer that the range between `lo` and
+        `hi` changed because of a change to the backers.
+        """
+        if self._checkpoints:
+            self._journal_range(lo, hi)
+        for parent, start in self._parents.items():
+            parent._journal_change(lo + start, hi + start)
+
+    def _journal_backer(self, start, data):
+        size = data._max_end if isinstance(data, Clemory) else len(data)
+        if size:
+            self._journal_change(start, start + size)
+
+    def checkpoint(self):
+        """
+        Take a checkpoint of the contents of this memory and of the memories nested in it.
+
+        Like :func:`fork`, this takes time in the number of backers and dirty pages, which are shared with the
+        checkpoint until they are next written to.
+
+        The memories nested in this one get checkpoints of their own, which are managed by this one and can't be used
+        directly. A token can only be used with the memory that returned it.
+
+        :return:    A token for :func:`changes_since`, :func:`rollback` and :func:`release_checkpoint`.
+        """
+        children = [(data, data.checkpoint()) for _, data in self._backers if isinstance(data, Clemory)]
+        token = self._next_checkpoint
+        self._next_checkpoint += 1
+        self._checkpoints[token] = (len(self._journal), (list(self._backers), dict(self._updates), children))
+        self._journal_limit = DIRTY_RANGES_LIMIT
+        self._owned_pages = set()
+        self._owned_backers = set()
+        return token
+
+    def changes_since(self, token):
+        """
+        Get the ranges of memory that were written to, or had their backers changed, since the checkpoint `token` was
+        taken. Writes are recorded as they are made, so a range can have been changed back to what it was before.
+
+        :return:    A sorted list of merged (start, end) tuples.
+        """
+        index, _ = self._checkpoints[token]
+        return self._merge_ranges(self._journal[index:])
+
+    def rollback(self, token):
+        """
+        Undo every write and every change to the backers made since the checkpoint `token` was taken, in this memory
+        and in the memories nested in it. The checkpoint stays valid, but the ones taken after it are released.
+        """
+        index, (backers, updates, children) = self._checkpoints[token]
+        for child, child_token in children:
+            child.rollback(child_token)
+
+        # let the parents and the flattened copy know about everything that changes back
+        for lo, hi in self.changes_since(token):
+            self._mark_dirty(lo, hi)
+
+        for start, data in self._backers:
+            if isinstance(data, Clemory):
+                data._parents.pop(self, None)
+        self._backers = list(backers)
+        for start, data in self._backers:
+            if isinstance(data, Clemory):
+                data._parents[self] = start
+        self._updates = dict(updates)
+        self._owned_pages = set()
+        self._owned_backers = set()
+        self._invalidate_index()
+
+        del self._journal[index:]
+        for newer in [t for t in self._checkpoints if t > token]:
+            self._release(newer)
+
+    def release_checkpoint(self, token):
+        """
+        Forget the checkpoint `token`, in this memory and in the memories nested in it.
+        """
+        _, (_, _, children) = self._checkpoints[token]
+        for child, child_token in children:
+            child.release_checkpoint(child_token)
+        self._release(token)
+
+    def _release(self, token):
+        del self._checkpoints[token]
+        if not self._checkpoints:
+            self._journal = [ ]
+        else:
+            # drop the part of the journal no checkpoint needs any more
+            oldest = min(index for index, _ in self._checkpoints.itervalues())
+            if oldest:
+                del self._journal[:oldest]
+                for t, (index, state) in self._checkpoints.items():
+                    self._checkpoints[t] = (index - oldest, state)
+
+    def _rebuild_index(self):
+        self._backer_starts = [ ]
+        self._backer_ends = [ ]
+        top = None
+        for start, data in self._backers:
+            if isinstance(data, Clemory):
+                end = start + data._max_end
             else:
-                for x in string:
-                    yield start + x
+                end = start + len(data)
+            if top is None or end > top:
+                top = end
+            self._backer_starts.append(start)
+            self._backer_ends.append(top)
+        self._index_dirty = False
+
+    @property
+    def _max_end(self):
+        """
+        One past the highest address covered by any backer, relative to this memory.
+        """
+        if self._index_dirty:
+            self._rebuild_index()
+        return self._backer_ends[-1] if self._backer_ends else 0
+
+    def _find_backer(self, k):
+        """
+        Find the backer holding address `k`, in O(log n) of the number of backers.
+
+        :return:    A tuple of (start, data) for the lowest-addressed backer containing `k`, or None if `k` is not
+                    mapped. Nested :class:`Clemory` backers only count as containing `k` if they have a backer for it.
+        """
+        if self._index_dirty:
+            self._rebuild_index()
+
+        # every backer starting at or before k is left of hi, and every backer left of lo ends at or before k
+        hi = bisect.bisect_right(self._backer_starts, k)
+        lo = bisect.bisect_right(self._backer_ends, k)
+        for i in xrange(lo, hi):
+            start, data = self._backers[i]
+            if isinstance(data, Clemory):
+                if data._find_backer(k - start) is not None:
+                    return start, data
+            elif k - start < len(data):
+                return start, data
+        return None
+
+    def _rebuild_leaves(self):
+        """
+        Build the flattened translation table of the leaf backers.
+
+        Where backers overlap, the one :func:`_find_backer` would pick wins, which is the one that comes first when
+        walking the backers depth-first in address order.
+        """
+        leaves = [ ]
+        for start, owner, owner_start, data in self._leaf_backers():
+            if len(data):
+                leaves.append((start, start + len(data), owner, start - owner_start, start, data))
+
+        ordered = sorted(leaves, key=lambda leaf: leaf[0])
+        if any(a[1] > b[0] for a, b in zip(ordered, ordered[1:])):
+            # cut the overlapping parts out of the backers of lower priority
+            ordered = [ ]
+            covered = [ ]
+            for lo, hi, owner, base, start, data in leaves:
+                pos = lo
+                i = max(bisect.bisect_right(covered, (lo, lo)) - 1, 0)
+                for covered_lo, covered_hi in covered[i:]:
+                    if covered_lo >= hi:
+                        break
+                    if covered_lo > pos:
+                        ordered.append((pos, covered_lo, owner, base, start, data))
+                    pos = max(pos, covered_hi)
+                if pos < hi:
+                    ordered.append((pos, hi, owner, base, start, data))
+                covered = self._merge_ranges(covered + [(lo, hi)])
+            ordered.sort(key=lambda leaf: leaf[0])
+
+        self._leaves = ordered
+        self._leaf_starts = [leaf[0] for leaf in ordered]
+
+    def _find_leaf(self, k):
+        """
+        Find the string or file backer holding address `k` with a single lookup in the flattened translation table.
+
+        :return:    A tuple of (start, end, owning Clemory, address of the owning Clemory, start of the backer, data), or
+                    None if `k` is not mapped.
+        """
+        if self._leaves is None:
+            self._rebuild_leaves()
+        i = bisect.bisect_right(self._leaf_starts, k) - 1
+        if i >= 0 and k < self._leaves[i][1]:
+            return self._leaves[i]
+        return None
+
+    def __iter__(self):
+        if self._leaves is None:
+            self._rebuild_leaves()
+        for lo, hi, _, _, _, _ in self._leaves:
+            for x in xrange(lo, hi):
+                yield x
 
     def __getitem__(self, k):
         return self.get_byte(k)
 
     def get_byte(self, k, orig=False):
-        if not orig and k in self._updates:
-            return self._updates[k]
-        else:
-            for start, data in self._backers:
-                if isinstance(data, str):
-                    if 0 <= k - start < len(data):
-                        return data[k - start]
-                elif isinstance(data, Clemory):
-                    try:
-                        return data.get_byte(k - start, orig=orig)
-                    except KeyError:
-                        pass
+        leaf = self._find_leaf(k)
+        if leaf is None:
             raise KeyError(k)
+        _, _, owner, base, start, data = leaf
+        if not orig:
+            page = owner._updates.get((k - base) >> PAGE_SHIFT)
+            if page is not None:
+                return chr(page[(k - base) & PAGE_MASK])
+        if isinstance(data, bytearray):
+            return chr(data[k - start])
+        return data[k - start]
 
     def __setitem__(self, k, v):
-        if k not in self:
+        leaf = self._find_leaf(k)
+        if leaf is None:
             raise IndexError(k)
-        self._updates[k] = v
-        self._needs_flattening_personal = True
+        owner, base = leaf[2], leaf[3]
+        owner._write_pages(k - base, v)
 
     def __contains__(self, k):
-        try:
-            self.__getitem__(k)
-            return True
-        except KeyError:
-            return False
+        return self._find_leaf(k) is not None
+
+    def _get_page(self, pageno):
+        """
+        Get the update page number `pageno` for writing, copying it from the backers if it isn't dirty yet, or from the
+        page shared with a fork if it is.
+        """
+        page = self._updates.get(pageno)
+        if page is None:
+            page = bytearray(PAGE_SIZE)
+            page_start = pageno << PAGE_SHIFT
+            self._copy_backers(page, page_start, page_start, page_start + PAGE_SIZE)
+            self._updates[pageno] = page
+            self._owned_pages.add(pageno)
+        elif pageno not in self._owned_pages:
+            page = self._updates[pageno] = bytearray(page)
+            self._owned_pages.add(pageno)
+        return page
+
+    def _copy_backers(self, buf, buf_addr, lo, hi):
+        """
+        Copy the data of the string and file backers between addresses `lo` and `hi` into the bytearray `buf`, which starts at
+        address `buf_addr`.
+        """
+        if self._index_dirty:
+            self._rebuild_index()
+        first = bisect.bisect_right(self._backer_ends, lo)
+        last = bisect.bisect_left(self._backer_starts, hi)
+        # go backwards, so that where backers overlap, the lowest one wins like it does for lookups
+        for i in xrange(last - 1, first - 1, -1):
+            start, data = self._backers[i]
+            if isinstance(data, Clemory):
+                continue
+            copy_lo = max(lo, start)
+            copy_hi = min(hi, start + len(data))
+            if copy_lo < copy_hi:
+                buf[copy_lo - buf_addr:copy_hi - buf_addr] = data[copy_lo - start:copy_hi - start]
+
+    def _refresh_pages(self, lo, hi):
+        """
+        Copy the current backer data between addresses `lo` and `hi` into the dirty pages covering it.
+        """
+        for pageno in self._pages_between(lo, hi):
+            page_start = pageno << PAGE_SHIFT
+            self._copy_backers(self._get_page(pageno), page_start, max(lo, page_start), min(hi, page_start + PAGE_SIZE))
+
+    def _pages_between(self, lo, hi):
+        """
+        Return the sorted numbers of the dirty pages overlapping the addresses between `lo` and `hi`.
+        """
+        if not self._updates or lo >= hi:
+            return [ ]
+        first = lo >> PAGE_SHIFT
+        last = (hi - 1) >> PAGE_SHIFT
+        if last - first < len(self._updates):
+            return [pageno for pageno in xrange(first, last + 1) if pageno in self._updates]
+        return sorted(pageno for pageno in self._updates if first <= pageno <= last)
+
+    def _overlay_pages(self, buf, addr, pagenos):
+        """
+        Lay the dirty pages `pagenos` over the bytearray `buf`, which holds the backer data starting at `addr`.
+        """
+        end = addr + len(buf)
+        for pageno in pagenos:
+            page_start = pageno << PAGE_SHIFT
+            lo = max(addr, page_start)
+            hi = min(end, page_start + PAGE_SIZE)
+            buf[lo - addr:hi - addr] = self._updates[pageno][lo - page_start:hi - page_start]
 
     def __getstate__(self):
         self._cbackers = [ ]
+        self._cbacker_starts = [ ]
+        self._cbacker_sources = [ ]
+        self._dirty_ranges = [ ]
         self._needs_flattening_personal = True
-        return self.__dict__
+        state = dict(self.__dict__)
+        del state['_parents']   # weak references can't be pickled, the parents re-register themselves on unpickling
+        del state['_owned_pages'] # pages and backers shared with forks may be pickled along with them
+        del state['_owned_backers']
+        state['_leaves'] = None
+        state['_leaf_starts'] = [ ]
+        state['_journal'] = [ ]
+        state['_checkpoints'] = { }
+        return state
 
     def __setstate__(self, data):
         self.__dict__.update(data)
+        self._owned_pages = set()
+        self._owned_backers = set()
+        if '_parents' not in self.__dict__:
+            self._parents = weakref.WeakKeyDictionary()
+        for start, backer in self._backers:
+            if isinstance(backer, Clemory):
+                if '_parents' not in backer.__dict__:
+                    backer._parents = weakref.WeakKeyDictionary()
+                backer._parents[self] = start
+
+    def fork(self):
+        """
+        Make a copy of this memory that can be written to without affecting this one, and the other way around.
+
+        The backers are shared between the two, and nested memories are forked along with this one. The update pages
+        are shared as well until either memory writes to them, so forking takes time in the number of backers and
+        dirty pages, not in the amount of memory.
+        """
+        clone = Clemory(self._arch, root=self._root)
+        for start, data in self._backers:
+            if isinstance(data, Clemory):
+                data = data.fork()
+                data._parents[clone] = start
+            clone._backers.append((start, data))
+        clone._index_dirty = True
+        clone._updates = dict(self._updates)
+        clone._pointer = self._pointer
+        clone._permissions = list(self._permissions)
+        clone._permission_starts = list(self._permission_starts)
+        # neither memory may write to the pages or backers in place any more
+        self._owned_pages = set()
+        self._owned_backers = set()
+        return clone
+
+    def set_permissions(self, start, end, permissions):
+        """
+        Set the permissions of the addresses between `start` and `end` in the permission map, replacing whatever was
+        set for them before.
+
+        The permission map is separate from the backers: it holds whatever the loader knows about the permissions of
+        memory, and it isn't looked up in nested memories.
+
+        :param permissions: An OR of PERM_READ, PERM_WRITE and PERM_EXEC.
+        """
+        if start >= end:
+            return
+        first = bisect.bisect_right(self._permission_starts, start) - 1
+        if first < 0 or self._permissions[first][1] <= start:
+            first += 1
+        last = bisect.bisect_left(self._permission_starts, end)
+
+        new = [ ]
+        if first < last:
+            lo, _, perms = self._permissions[first]
+            if lo < start:
+                new.append((lo, start, perms))
+        new.append((start, end, permissions))
+        if first < last:
+            _, hi, perms = self._permissions[last - 1]
+            if hi > end:
+                new.append((end, hi, perms))
+        self._permissions[first:last] = new
+        self._permission_starts[first:last] = [range_start for range_start, _end, _perms in new]
+
+    def permissions(self, addr):
+        """
+        Look up the permissions of address `addr` in the permission map, in O(log n) of its size.
+
+        :return:    An OR of PERM_READ, PERM_WRITE and PERM_EXEC, or None if no permissions are known for `addr`.
+        """
+        i = bisect.bisect_right(self._permission_starts, addr) - 1
+        if i >= 0 and addr < self._permissions[i][1]:
+            return self._permissions[i][2]
+        return None
+
+    def permission_regions(self, start=None, end=None, permissions=None):
+        """
+        Split the part of the permission map between `start` and `end` into regions of the same permissions. Adjacent
+        regions with the same permissions are merged.
+
+        :param permissions: If given, only return the regions that have at least all of these permissions.
+        :return:            A sorted list of (start, end, permissions) tuples.
+        """
+        i = 0 if start is None else max(bisect.bisect_right(self._permission_starts, start) - 1, 0)
+        out = [ ]
+        for lo, hi, perms in self._permissions[i:]:
+            if start is not None:
+                lo = max(lo, start)
+            if end is not None:
+                if lo >= end:
+                    break
+                hi = min(hi, end)
+            if lo >= hi or (permissions is not None and perms & permissions != permissions):
+                continue
+            if out and out[-1][1] == lo and out[-1][2] == perms:
+                out[-1] = (out[-1][0], hi, perms)
+            else:
+                out.append((lo, hi, perms))
+        return out
+
+    def footprint(self):
+        """
+        Account for the memory held by this memory and the memories nested in it. This takes time in the number of
+        backers and update pages, not in their size.
+
+        Pages and backers shared with forks or checkpoints are counted in full by each memory sharing them.
+
+        :return:    A dict of byte counts, with the keys:
+
+                    - `backers`:    held in string and bytearray backers
+                    - `mapped`:     mapped from files by file backers, which the OS can share and page out
+                    - `updates`:    held in update pages
+                    - `cbackers`:   duplicated into flattened C buffers, on the root memory
+                    - `per_backer`: a list of (start, kind, size) tuples for each string, bytearray, file or zero
+                                    backer, where kind is 'str', 'bytearray', 'file' or 'zero'
+        """
+        out = {'backers': 0, 'mapped': 0, 'updates': 0, 'cbackers': 0, 'per_backer': [ ]}
+        owners = set()
+        for start, owner, _, data in self._leaf_backers():
+            owners.add(owner)
+            if isinstance(data, FileBacker):
+                out['mapped'] += data.filesize
+                out['per_backer'].append((start, 'file', data.filesize))
+            elif isinstance(data, ZeroBacker):
+                out['per_backer'].append((start, 'zero', 0))
+            else:
+                out['backers'] += len(data)
+                out['per_backer'].append((start, 'str' if isinstance(data, str) else 'bytearray', len(data)))
+        out['updates'] = sum(len(owner._updates) for owner in owners | {self}) * PAGE_SIZE
+        out['cbackers'] = sum(_ffi.sizeof(cbacker) for _, cbacker in self._cbackers)
+        return out
 
     def read_bytes(self, addr, n, orig=False):
         """
-        Read `n` bytes at address `addr` in memory and return an array of bytes.
+        Read `n` bytes at address `addr` in memory and return them as a string.
+
+        :raises KeyError:   If any address in the range is not backed.
+        """
+        data = self._read_partial(addr, n, orig=orig)
+        if len(data) < n:
+            raise KeyError(addr + len(data))
+        return data
+
+    def read_view(self, addr, n, orig=False):
         """
-        b = []
-        for i in range(addr, addr+n):
-            b.append(self.get_byte(i, orig=orig))
-        return b
+        Get a read-only memoryview of `n` bytes at address `addr` in memory.
+
+        If the range lies within a single string, file or zero backer and has not been written to, the view points
+        straight into the backer and nothing is copied. Otherwise the bytes are read into a new string first, just like
+        :func:`read_bytes`. Bytearray backers are always copied, since they can be written in place or shared with forks.
+
+        :raises KeyError:   If any address in the range is not backed.
+        """
+        return memoryview(self._read_buffer(addr, n, orig=orig))
+
+    def _read_buffer(self, addr, n, orig=False):
+        """
+        Like :func:`read_view`, but return an old-style buffer object, or a string when the bytes have to be copied.
+        Unlike memoryviews, these can be handed to numpy on Python 2.
+        """
+        leaf = self._find_leaf(addr)
+        if leaf is not None:
+            _, hi, owner, base, start, data = leaf
+            if addr + n <= hi and (orig or not owner._pages_between(addr - base, addr + n - base)):
+                if isinstance(data, (FileBacker, ZeroBacker)):
+                    buf = data.buffer(addr - start, addr - start + n)
+                    if buf is not None:
+                        return buf
+                elif isinstance(data, str):
+                    return buffer(data, addr - start, n)
+        return self.read_bytes(addr, n, orig=orig)
+
+    def _read_partial(self, addr, n, orig=False):
+        """
+        Read up to `n` bytes at address `addr`, stopping early at the first address that is not backed.
+
+        The data is taken from the backers in as few slices as possible, then any updates in the range are applied on
+        top of it.
+        """
+        if self._leaves is None:
+            self._rebuild_leaves()
+        chunks = [ ]
+        pos = addr
+        end = addr + n
+        i = bisect.bisect_right(self._leaf_starts, addr) - 1
+        while pos < end and 0 <= i < len(self._leaves):
+            lo, hi, owner, base, start, data = self._leaves[i]
+            if not lo <= pos < hi:
+                break
+            stop = min(end, hi)
+            chunks.append(owner._backer_bytes(start - base, data, pos - base, stop - base, orig=orig))
+            pos = stop
+            i += 1
+
+        return ''.join(chunks)
+
+    def _backer_bytes(self, start, data, lo, hi, orig=False):
+        """
+        Get the contents of the string or file backer `data` at `start` between the addresses `lo` and `hi`, with the
+        update pages laid over it unless `orig` is set.
+        """
+        out = data[lo - start:hi - start]
+        pagenos = self._pages_between(lo, hi) if not orig else None
+        if pagenos:
+            out = bytearray(out)
+            self._overlay_pages(out, lo, pagenos)
+        return str(out)
 
     def write_bytes(self, addr, data):
         """
         Write bytes from `data` at address `addr`.
+
+        :raises IndexError: If any address in the range is not backed.
+        """
+        if self._leaves is None:
+            self._rebuild_leaves()
+        pos = addr
+        end = addr + len(data)
+        i = bisect.bisect_right(self._leaf_starts, addr) - 1
+        while pos < end:
+            if not 0 <= i < len(self._leaves) or not self._leaves[i][0] <= pos < self._leaves[i][1]:
+                raise IndexError(pos)
+            _, hi, owner, base, _, _ = self._leaves[i]
+            stop = min(end, hi)
+            owner._write_pages(pos - base, data[pos - addr:stop - addr])
+            pos = stop
+            i += 1
+
+    def _write_pages(self, addr, data):
         """
-        for i, c in enumerate(data):
-            self[addr+i] = c
+        Write `data` at address `addr` into the update pages of this memory, which must all be backed by it directly.
+        """
+        end = addr + len(data)
+        self._mark_dirty(addr, end)
+        pos = addr
+        while pos < end:
+            page_stop = min(end, (pos | PAGE_MASK) + 1)
+            page_start = pos & ~PAGE_MASK
+            self._get_page(pos >> PAGE_SHIFT)[pos - page_start:page_stop - page_start] = data[pos - addr:page_stop - addr]
+            pos = page_stop
 
     def write_bytes_to_backer(self, addr, data):
         """
         Write bytes from `data` at address `addr` to backer instead of self._updates. This is only needed when writing a
         huge amount of data.
-        """
 
+        Each backer written to is turned into a bytearray owned by this memory the first time, and written in place
+        after that. File and zero backers aren't copied whole: the pages written to are split out of them into bytearray
+        backers of their own. Unbacked parts of the range get new backers, except that data written right after the end
+        of the last string or bytearray backer is appended to it.
+        """
         pos = addr
-        to_insert = [ ]
-        i = 0
+        end = addr + len(data)
+        while pos < end:
+            found = self._find_backer(pos)
+            if found is not None:
+                start, backer = found
+                if isinstance(backer, Clemory):
+                    stop = min(end, start + backer._max_end)
+                    backer.write_bytes_to_backer(pos - start, data[pos - addr:stop - addr])
+                else:
+                    stop = min(end, start + len(backer))
+                    owned_start, owned = self._own_backer(start, pos, stop)
+                    owned[pos - owned_start:stop - owned_start] = data[pos - addr:stop - addr]
+                    self._mark_dirty(pos, stop)
+                pos = stop
+                continue
 
-        while i < len(self._backers) and len(data):
-            start, backer_data = self._backers[i] # self._backers is always sorted
-            size = len(backer_data)
-            stop = start + size
-            if pos >= start:
-                if pos < stop:
-                    if pos + len(data) > stop:
-                        new_backer_data = backer_data[ : pos - start] + data[ : stop - pos]
-                        self._backers[i] = (start, new_backer_data)
-
-                        # slicing data
-                        data = data[ stop - pos : ]
-                        pos = stop
-                    else:
-                        new_backer_data = backer_data[ : pos - start] + data + backer_data[pos - start + len(data) : ]
-                        self._backers[i] = (start, new_backer_data)
-                        # We are done
-                        break
-                i += 1
+            # pos is in a hole, which is filled up to the next backer
+            i = bisect.bisect_right(self._backer_starts, pos)
+            if i < len(self._backers):
+                stop = min(end, self._backers[i][0])
+                self._backers.insert(i, (pos, bytearray(data[pos - addr:stop - addr])))
+                self._owned_backers.add(pos)
             else:
-                # Look forward and see if we should insert a new backer
-                if i < len(self._backers) - 1:
-                    if pos + len(data) <= start:
-                        to_insert.append((pos, data[ : start - pos]))
-
-                        data = data[start - pos : ]
-                        pos = start
-
-                    else:
-                        # we reach the end of our data to insert
-                        to_insert.append((pos, data))
-
-                        break
+                stop = end
+                prev_start, prev = self._backers[-1] if self._backers else (None, None)
+                if isinstance(prev, (str, bytearray)) and prev_start + len(prev) == pos:
+                    _, prev = self._own_backer(prev_start)
+                    try:
+                        prev.extend(data[pos - addr:])
+                    except BufferError:
+                        # there are views of it, so it can't be resized in place
+                        self._backers[-1] = (prev_start, prev + data[pos - addr:])
                 else:
-                    # seems we reach the end of the list...
-                    to_insert.append((pos, data))
+                    self._backers.append((pos, bytearray(data[pos - addr:])))
+                    self._owned_backers.add(pos)
+            self._invalidate_index()
+            self._mark_dirty(pos, stop)
+            pos = stop
 
-                    break
+        # the written data also replaces whatever was in the update pages
+        self._refresh_pages(addr, end)
 
-        # Insert the blocks that are needed to insert into self._backers
-        for seg_start, seg_data in to_insert:
-            bisect.insort(self._backers, (seg_start, seg_data))
+    def _own_backer(self, start, lo=None, hi=None):
+        """
+        Get the backer at `start` as a bytearray that can be written to in place, copying it first if it's a string or
+        shared with a fork.
 
-        # Set the flattening_needed flag
-        self._needs_flattening_personal = True
+        File and zero backers aren't copied whole. Instead, the pages between the addresses `lo` and `hi` are split out
+        of them into a new bytearray backer, with the rest of the backer on either side of it.
+
+        :return:    A tuple of the start of the bytearray and the bytearray.
+        """
+        i = bisect.bisect_left(self._backers, (start,))
+        data = self._backers[i][1]
+        if isinstance(data, (FileBacker, ZeroBacker)):
+            split_lo = max(start, lo & ~PAGE_MASK)
+            split_hi = min(start + len(data), ((hi - 1) | PAGE_MASK) + 1)
+            owned = bytearray(data[split_lo - start:split_hi - start])
+            del self._backers[i]
+            if split_lo > start:
+                bisect.insort(self._backers, (start, data._slice(0, split_lo - start)))
+            bisect.insort(self._backers, (split_lo, owned))
+            if split_hi < start + len(data):
+                bisect.insort(self._backers, (split_hi, data._slice(split_hi - start, len(data))))
+            self._owned_backers.add(split_lo)
+            self._invalidate_index()
+            return split_lo, owned
+        if not isinstance(data, bytearray) or start not in self._owned_backers:
+            data = bytearray(data[0:len(data)])
+            self._backers[i] = (start, data)
+            self._owned_backers.add(start)
+            self._invalidate_index()
+        return start, data
 
     def read_addr_at(self, where, orig=False):
         """
         Read addr stored in memory as a series of bytes starting at `where`.
         """
-        return struct.unpack(self._arch.struct_fmt(), ''.join(self.read_bytes(where, self._arch.bytes, orig=orig)))[0]
+        return _get_struct(self._arch.struct_fmt()).unpack(self.read_bytes(where, self._arch.bytes, orig=orig))[0]
 
     def write_addr_at(self, where, addr):
         """
         Writes `addr` into a series of bytes in memory at `where`.
         """
-        by = struct.pack(self._arch.struct_fmt(), addr % (2**self._arch.bits))
+        by = _get_struct(self._arch.struct_fmt()).pack(addr % (2**self._arch.bits))
         self.write_bytes(where, by)
 
-    @property
-    def _stride_repr(self):
-        out = []
-        for start, data in self._backers:
-            if isinstance(data, str):
-                out.append((start, bytearray(data)))
-            else:
-                out += map(lambda (substart, subdata), start=start: (substart+start, subdata), data._stride_repr)
-        for key, val in self._updates.iteritems():
-            for start, data in out:
-                if start <= key < start + len(data):
-                    data[key - start] = val
-                    break
+    def _addr_runs(self, addrs):
+        """
+        Split a list of addresses into runs of consecutive pointer-sized slots, as tuples of (start, count).
+        """
+        runs = [ ]
+        size = self._arch.bytes
+        for addr in addrs:
+            if runs and runs[-1][0] + runs[-1][1] * size == addr:
+                runs[-1][1] += 1
             else:
-                raise ValueError('There was an update to a Clemory not on top of any backer')
+                runs.append([addr, 1])
+        return runs
+
+    def read_addrs(self, addrs, orig=False):
+        """
+        Read the addrs stored in memory at each address in `addrs`.
+
+        Consecutive pointer slots, like the entries of an array, are read with a single read and unpacked in one go.
+
+        :param addrs:   A list of the addresses to read from.
+        :return:        A list of the values read, in the same order as `addrs`.
+        """
+        fmt = self._arch.struct_fmt()
+        size = self._arch.bytes
+        out = [ ]
+        for start, count in self._addr_runs(addrs):
+            out.extend(struct.unpack('%s%d%s' % (fmt[0], count, fmt[1:]), self.read_bytes(start, size * count, orig=orig)))
+        return out
+
+    def write_addrs(self, writes):
+        """
+        Write a number of addrs into memory.
+
+        Values for consecutive pointer slots are packed in one go and written with a single write.
+
+        :param writes:  A list of tuples of (where, addr).
+        """
+        fmt = self._arch.struct_fmt()
+        mask = 2**self._arch.bits
+        i = 0
+        for start, count in self._addr_runs([where for where, _ in writes]):
+            values = [addr % mask for _, addr in writes[i:i + count]]
+            self.write_bytes(start, struct.pack('%s%d%s' % (fmt[0], count, fmt[1:]), *values))
+            i += count
+
+    def read_array(self, addr, count, fmt=None, endness=None, orig=False):
+        """
+        Read an array of `count` integers starting at address `addr`, like a table of GOT slots or hash buckets.
+
+        If numpy is available this is a numpy array, which is a view straight into the backer when the range lies in a
+        single backer and has not been written to (see :func:`read_view`). Otherwise it is an `array.array`, or a
+        tuple if the platform has no array type of the right size.
+
+        :param fmt:         The struct format character for the elements. Defaults to pointer-sized unsigned ints.
+        :param endness:     'Iend_LE' or 'Iend_BE'. Defaults to the endness of the arch.
+        :raises KeyError:   If any address in the array is not backed.
+        """
+        if fmt is None:
+            fmt = self._arch.struct_fmt()[1:]
+        if endness is None:
+            endness = self._arch.memory_endness if self._arch is not None else None
+        order = '=' if endness is None else '<' if endness == 'Iend_LE' else '>'
+        size = struct.calcsize('=' + fmt)
+        data = self._read_buffer(addr, count * size, orig=orig)
+
+        if numpy is not None:
+            return numpy.frombuffer(data, dtype=numpy.dtype(order + fmt), count=count)
+
+        typecode = _array_typecodes.get(fmt)
+        if typecode is None:
+            return struct.unpack('%s%d%s' % (order, count, fmt), str(data))
+        out = array.array(typecode, str(data))
+        if order != '=' and order != ('<' if sys.byteorder == 'little' else '>'):
+            out.byteswap()
         return out
 
+    def _extents(self):
+        """
+        Get the contiguous ranges of backed memory, as a sorted list of (start, end) tuples.
+        """
+        if self._leaves is None:
+            self._rebuild_leaves()
+        return self._merge_ranges((lo, hi) for lo, hi, _, _, _, _ in self._leaves)
+
+    def iter_extents(self, orig=False):
+        """
+        Iterate over the contiguous regions of memory, with adjacent backers merged together.
+
+        The data of each region is read only when the iteration reaches it, with the updates applied unless `orig` is
+        set. It is a memoryview, which points straight into the backer if the region is a single unmodified backer.
+
+        :return:    An iterator of (start, end, data) tuples, in increasing order of address.
+        """
+        for lo, hi in self._extents():
+            yield lo, hi, self.read_view(lo, hi - lo, orig=orig)
+
+    def _dirty_ranges_of_leaves(self):
+        """
+        Get the ranges of memory covered by update pages, as a sorted list of merged (start, end) tuples.
+        """
+        if self._leaves is None:
+            self._rebuild_leaves()
+        ranges = [ ]
+        for lo, hi, owner, base, _, _ in self._leaves:
+            for pageno in owner._pages_between(lo - base, hi - base):
+                page_start = (pageno << PAGE_SHIFT) + base
+                ranges.append((max(lo, page_start), min(hi, page_start + PAGE_SIZE)))
+        return self._merge_ranges(ranges)
+
+    def iter_dirty_extents(self):
+        """
+        Iterate over the regions of memory that were written to, like :func:`iter_extents`. Writes are tracked a page at
+        a time, so the regions are made of whole pages, except where a page is only partly backed.
+
+        :return:    An iterator of (start, end, data) tuples, in increasing order of address.
+        """
+        for lo, hi in self._dirty_ranges_of_leaves():
+            yield lo, hi, self.read_view(lo, hi - lo)
+
+    @staticmethod
+    def _masked_byte_regex(byte, mask):
+        """
+        Get a regex matching every byte that is equal to `byte` in the bits set in `mask`.
+        """
+        byte, mask = ord(byte), ord(mask)
+        if mask == 0xff:
+            return re.escape(chr(byte))
+        if mask == 0:
+            return '.'
+        return '[%s]' % ''.join(re.escape(chr(b)) for b in xrange(256) if b & mask == byte & mask)
+
+    def find(self, pattern, start=None, end=None, mask=None, orig=False):
+        """
+        Search memory for a pattern of bytes, yielding the address of every match in increasing order.
+
+        Each contiguous range of memory is searched as a whole, so matches can straddle the boundary between two
+        adjacent backers, but never a hole in memory. Writes to memory are taken into account unless `orig` is set.
+
+        Fixed-length patterns are searched for in chunks of FIND_CHUNK_SIZE bytes and overlapping matches are all
+        reported. A compiled regex is run over each contiguous range in one go, with the usual `finditer` semantics.
+
+        :param pattern: A string of bytes to look for, or a compiled regular expression.
+        :param start:   The lowest address a match may start at.
+        :param end:     The address every match has to end before.
+        :param mask:    A string as long as `pattern`. Only the bits set in the mask are compared, so a "\\x00" in
+                        the mask is a wildcard byte.
+        """
+        if mask is not None:
+            if len(mask) != len(pattern):
+                raise ValueError("The mask must be as long as the pattern")
+            length = len(pattern)
+            regex = re.compile(''.join(self._masked_byte_regex(b, m) for b, m in zip(pattern, mask)), re.DOTALL)
+            def search(data, pos):
+                match = regex.search(data, pos)
+                return -1 if match is None else match.start()
+        elif isinstance(pattern, str):
+            length = len(pattern)
+            search = lambda data, pos: data.find(pattern, pos)
+        else:
+            length = None
+        if length == 0:
+            raise ValueError("Can't search for an empty pattern")
+
+        for lo, hi in self._extents():
+            if start is not None:
+                lo = max(lo, start)
+            if end is not None:
+                hi = min(hi, end)
+
+            if length is None:
+                if lo < hi:
+                    for match in pattern.finditer(self.read_bytes(lo, hi - lo, orig=orig)):
+                        yield lo + match.start()
+                continue
+
+            pos = lo
+            while hi - pos >= length:
+                # consecutive chunks overlap by length - 1 bytes, so every match is entirely inside exactly one chunk
+                chunk_end = min(hi, pos + FIND_CHUNK_SIZE + length - 1)
+                data = self.read_bytes(pos, chunk_end - pos, orig=orig)
+                i = search(data, 0)
+                while i != -1:
+                    yield pos + i
+                    i = search(data, i + 1)
+                pos = chunk_end - length + 1
+
+    def _leaf_backers(self, base=0):
+        """
+        Yield every string and file backer of this memory and of the memories nested in it, as tuples of (absolute
+        start, owning Clemory, start in the owning Clemory, data).
+        """
+        for start, data in self._backers:
+            if isinstance(data, Clemory):
+                for leaf in data._leaf_backers(base + start):
+                    yield leaf
+            else:
+                yield base + start, self, start, data
+
+    @property
+    def _stride_repr(self):
+        return [(start, bytearray(owner._backer_bytes(owner_start, data, owner_start, owner_start + len(data))))
+                for start, owner, owner_start, data in self._leaf_backers()]
+
     @property
     def stride_repr(self):
         """
@@ -237,7 +1354,7 @@ class Clemory(object):
         else:
             out = self.read_bytes(self._pointer, nbytes)
             self._pointer += nbytes
-            return ''.join(out)
+            return out
 
     @property
     def cbackers(self):
@@ -252,52 +1369,181 @@ class Clemory(object):
 
     def _flatten_to_c(self):
         """
-        Flattens memory backers to C-backed strings.
+        Flattens memory backers to C-backed strings. Backers which are adjacent in memory, like consecutive segments or
+        sections, are merged into a single C buffer.
+
+        Only the parts of memory that changed since the last flattening are copied again. If the layout of the backers
+        is unchanged, that's just the ranges that were written to. Otherwise the cbackers made from the same backers as
+        before are kept, the ones which cover the same range but with different backers are refilled in place, and
+        only new ranges get new cbackers.
         """
 
         if not self._root:
             raise ValueError("Pulling C data out of a non-root Clemory is disallowed!")
 
-        ffi = cffi.FFI()
+        if self._needs_flattening_personal:
+            # group the backers into runs of adjacent ones
+            strides = [ ]
+            for start, owner, owner_start, data in sorted(self._leaf_backers(), key=lambda leaf: leaf[0]):
+                if strides and strides[-1][0] + strides[-1][1] == start:
+                    stride_start, size, sources = strides[-1]
+                    sources.append((size, owner, owner_start, data))
+                    strides[-1] = (stride_start, size + len(data), sources)
+                else:
+                    strides.append((start, len(data), [(0, owner, owner_start, data)]))
 
-        # Considering the fact that there are much less bytes in self._updates than amount of bytes in backer,
-        # this way instead of calling self.__getitem__() is actually faster
-        strides = self._stride_repr
+            old = { }
+            for (start, cbacker), sources in zip(self._cbackers, self._cbacker_sources):
+                old[(start, len(cbacker))] = (sources, cbacker)
 
-        self._cbackers = [ ]
-        for start, data in strides:
-            cbacker = ffi.new("unsigned char [%d]" % len(data), str(data))
-            self._cbackers.append((start, cbacker))
+            self._cbackers = [ ]
+            self._cbacker_sources = [ ]
+            for start, size, sources in strides:
+                old_sources, cbacker = old.pop((start, size), (None, None))
+                if cbacker is None:
+                    cbacker = _ffi.new("unsigned char [%d]" % size, self._stride_bytes(sources, 0, size))
+                elif not self._same_sources(sources, old_sources):
+                    _ffi.memmove(cbacker, self._stride_bytes(sources, 0, size), size)
+                self._cbackers.append((start, cbacker))
+                self._cbacker_sources.append(sources)
+            self._cbacker_starts = [start for start, _ in self._cbackers]
+            self._needs_flattening_personal = False
 
-    @property
-    def _needs_flattening(self):
+        # refresh the ranges that were written to
+        dirty, self._dirty_ranges = self._dirty_ranges, [ ]
+        self._dirty_ranges_limit = DIRTY_RANGES_LIMIT
+        for lo, hi in self._merge_ranges(dirty):
+            i = max(bisect.bisect_right(self._cbacker_starts, lo) - 1, 0)
+            while i < len(self._cbackers) and self._cbacker_starts[i] < hi:
+                start, cbacker = self._cbackers[i]
+                patch_lo = max(lo, start) - start
+                patch_hi = min(hi, start + len(cbacker)) - start
+                if patch_lo < patch_hi:
+                    _ffi.memmove(cbacker + patch_lo, self._stride_bytes(self._cbacker_sources[i], patch_lo, patch_hi),
+                                 patch_hi - patch_lo)
+                i += 1
+
+    @staticmethod
+    def _stride_bytes(sources, lo, hi):
         """
-        WARNING:
-        ONLY use this property if you're going to flatten it immediately after seeing a True result
-        This is what is expected
-        debuggers beware
+        Get the current contents of a cbacker made from `sources` between the offsets `lo` and `hi`.
         """
-        out = self._needs_flattening_personal
-        for backer in self._backers:
-            if isinstance(backer[1], Clemory):
-                out |= backer[1]._needs_flattening
+        out = [ ]
+        for offset, owner, owner_start, data in sources:
+            piece_lo = max(lo, offset)
+            piece_hi = min(hi, offset + len(data))
+            if piece_lo < piece_hi:
+                shift = owner_start - offset
+                out.append(owner._backer_bytes(owner_start, data, piece_lo + shift, piece_hi + shift))
+        return ''.join(out)
 
-        self._needs_flattening_personal = False
+    @staticmethod
+    def _same_sources(sources, old_sources):
+        if old_sources is None or len(sources) != len(old_sources):
+            return False
+        for new, old in zip(sources, old_sources):
+            if new[0] != old[0] or any(a is not b for a, b in zip(new[1:], old[1:])):
+                return False
+        return True
+
+    @staticmethod
+    def _merge_ranges(ranges):
+        """
+        Sort a list of (start, end) tuples, merging the ones that overlap or touch.
+        """
+        out = [ ]
+        for lo, hi in sorted(ranges):
+            if out and lo <= out[-1][1]:
+                if hi > out[-1][1]:
+                    out[-1] = (out[-1][0], hi)
+            else:
+                out.append((lo, hi))
         return out
 
+    @property
+    def _needs_flattening(self):
+        """
+        Whether the cbackers are out of date. Changes to nested memories are pushed up to the root as they happen, so
+        this doesn't need to look at them.
+        """
+        return self._needs_flattening_personal or bool(self._dirty_ranges)
 
-    def read_bytes_c(self, addr):
+    def read_bytes_c(self, addr, n=None):
         """
-        Read `n` bytes at address `addr` in cbacked memory, and returns a cffi buffer pointer.
+        Read bytes at address `addr` in cbacked memory, and returns a cffi buffer pointer along with the number of bytes
+        that can be read from it.
 
-        Note: We don't support reading across segments for performance concerns.
+        Since adjacent backers are flattened into a single buffer, the read can cross from one segment or section into
+        the next one, as long as there is no gap in between.
+
+        :param addr:        The address to read from.
+        :param n:           The number of bytes that are going to be read, if it is known. When given, a KeyError is
+                            raised unless all of them are available from the returned pointer.
         """
 
         if self._needs_flattening:
             self._flatten_to_c()
 
-        for start, cbacker in self._cbackers:
-            if addr >= start and addr < start + len(cbacker):
-                return cbacker + (addr - start), start + len(cbacker) - addr
+        i = bisect.bisect_right(self._cbacker_starts, addr) - 1
+        if i >= 0:
+            start, cbacker = self._cbackers[i]
+            if addr < start + len(cbacker):
+                size = start + len(cbacker) - addr
+                if n is not None and n > size:
+                    raise KeyError(start + len(cbacker))
+                return cbacker + (addr - start), size
 
         raise KeyError(addr)
+
+class ClemoryStream(object):
+    """
+    A read-only file-like view of a :class:`Clemory`, with its own position, for libraries that parse structures out of
+    streams, like pyelftools.
+
+    Reads that start at an address that is not backed raise a KeyError, like :func:`Clemory.read_bytes` does, since
+    parsers can't tell an empty read apart from an empty string or table. Reads that start in backed memory stop early
+    at the first address that is not backed, like reads at the end of a file do.
+    """
+    def __init__(self, memory, pos=0):
+        """
+        :param memory:  The Clemory to read from.
+        :param pos:     The initial position in the stream.
+        """
+        self.memory = memory
+        self._pos = pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.memory._max_end
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = max(self.memory._max_end - self._pos, 0)
+        data = self.memory._read_partial(self._pos, n)
+        if n and not data:
+            raise KeyError(self._pos)
+        self._pos += len(data)
+        return data
+
+    def readinto(self, buf):
+        """
+        Read into the writable buffer `buf`, as much as it can hold.
+
+        :return:    The number of bytes read.
+        :raises KeyError:   If the current position is not backed.
+        """
+        data = self.memory._read_partial(self._pos, len(buf))
+        if len(buf) and not data:
+            raise KeyError(self._pos)
+        buf[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        pass
@@ -0,0 +1,367 @@
+import os
+import copy
+import errno
+import threading
+import hashlib
+import tempfile
+import cPickle as pickle
+from UserDict import DictMixin
+
+from .errors import CLEError, CLECompatibilityError
+from .memory import FileBacker
+from .patched_stream import PatchedStream
+from .cached_stream import BlockCachedStream
+
+import logging
+l = logging.getLogger('cle.object_cache')
+
+__all__ = ('ObjectCache', 'SharedObjectCache', 'shared_object_cache')
+
+# bump this whenever a change to the backends makes the objects already in caches out of date
+CACHE_VERSION = 2
+HASH_CHUNK_SIZE = 0x100000
+
+def _make_compatible(obj, compatible_with):
+    if compatible_with is not None and compatible_with.arch != obj.arch:
+        raise CLECompatibilityError("Binary %s not compatible with arch %s" % (obj.binary, compatible_with.arch))
+    obj.compatible_with = compatible_with
+
+class ObjectCache(object):
+    """
+    An on-disk cache of loaded objects, so that loading the same file with the same options again doesn't have to parse
+    it all over again.
+
+    Entries are keyed by the real path of the file and a hash of its contents and of the options it was loaded with,
+    so a file that changes simply stops hitting the cache, and an entry is only ever used for the file it was made
+    from. Each entry is a pickle of the object. Its memory refers back to ranges of the files it was read or mapped
+    from instead of holding a copy of them (see :class:`FileString` and :class:`FileBacker`), so an entry mostly holds
+    the parsed symbols and relocations, and is a fraction of the size of its file: about a seventh for libc.
+
+    Entries are written to a temporary file and renamed into place, so any number of processes can share a cache
+    directory: a reader sees either a whole entry or none at all, and when two processes write the same entry the last
+    one wins.
+    """
+    def __init__(self, directory):
+        """
+        :param directory:   The directory to keep the cache in. It is created if it doesn't exist.
+        """
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(directory):
+                raise
+
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '<ObjectCache %s>' % self.directory
+
+    @staticmethod
+    def key(path, options, is_main_bin=False):
+        """
+        Compute the key of the entry for the file at `path` loaded with the given options.
+
+        :param str path:            The path to the file
+        :param dict options:        The keyword arguments for the backend
+        :param bool is_main_bin:    Whether the file is being loaded as the main binary
+        """
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ''):
+                h.update(chunk)
+        h.update(repr((CACHE_VERSION, os.path.realpath(path), sorted(options.items()), is_main_bin)))
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def load(self, key, compatible_with=None):
+        """
+        Look up an object in the cache.
+
+        :param str key:         The key of the entry, from :meth:`key`
+        :param compatible_with: The object the loaded object must be compatible with, as for the backends
+        :return:                The object, or None if it isn't in the cache, or if the files its memory is mapped
+                                from changed since it was stored.
+        """
+        try:
+            f = open(self._entry_path(key), 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+
+        try:
+            with f:
+                unpickler = pickle.Unpickler(f)
+                unpickler.persistent_load = lambda pid: compatible_with
+                obj = unpickler.load()
+            # map the files now, so that they are checked against the hashes they were stored with
+            for _, _, _, data in obj.memory._leaf_backers() if obj.memory is not None else ():
+                if isinstance(data, FileBacker):
+                    data.mapping # pylint: disable=pointless-statement
+        except CLEError as e:
+            l.debug("Cache entry %s is out of date: %s", key, e)
+            self.misses += 1
+            return None
+        except Exception: # pylint: disable=broad-except
+            l.warning("Couldn't load cache entry %s, ignoring it", key, exc_info=True)
+            self.misses += 1
+            return None
+
+        _make_compatible(obj, compatible_with)
+        self.hits += 1
+        l.debug("Loaded %s from the cache", obj.binary)
+        return obj
+
+    def store(self, key, obj, compatible_with=None):
+        """
+        Put an object into the cache. Objects that can't be pickled, like the ones loaded from streams, are silently
+        left out.
+
+        :param str key:         The key of the entry, from :meth:`key`
+        :param obj:             The freshly loaded object
+        :param compatible_with: The object `obj` was loaded to be compatible with. It is left out of the entry, and
+                                replaced with the one given to :meth:`load`.
+        :return:                Whether the object was cached.
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + key, suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = lambda x: 'compatible_with' if x is compatible_with and x is not None else None
+                pickler.dump(obj)
+            os.rename(tmp_path, self._entry_path(key))
+        except Exception as e: # pylint: disable=broad-except
+            l.debug("Not caching %s: %s", obj.binary, e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+
+class SharedObjectCache(object):
+    """
+    A cache of loaded objects kept in memory, so that the loaders in a process can share the libraries they have in
+    common instead of each parsing its own.
+
+    The cache keeps a pristine copy of each object, which no loader ever sees. Every lookup returns a new copy of it,
+    which the loader is free to rebase and relocate. The copies share everything that doesn't change once an object is
+    loaded with the pristine one: the sections, segments, and dynamic and PLT tables, and the backers of its memory,
+    whose pages are only copied when a loader writes to them (see :meth:`Clemory.fork`). Each copy gets its own stream,
+    ELF reader and string, symbol and hash tables, which keep positions in the stream and memory, so that loaders in
+    different threads don't move each other's. It also gets its own relocations, which hold the state of resolving
+    them, but its symbols are only copied, to bind them to the copy, when they are first looked up (see
+    :class:`_BoundSymbols`).
+
+    Entries are keyed by the path, size and modification time of the file and the options it was loaded with.
+    """
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '<SharedObjectCache with %d objects>' % len(self._objects)
+
+    def __len__(self):
+        return len(self._objects)
+
+    @staticmethod
+    def key(path, options, is_main_bin=False):
+        """
+        Compute the key of the entry for the file at `path` loaded with the given options.
+
+        :param str path:            The path to the file
+        :param dict options:        The keyword arguments for the backend
+        :param bool is_main_bin:    Whether the file is being loaded as the main binary
+        """
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        return (path, st.st_size, st.st_mtime, repr(sorted(options.items())), is_main_bin)
+
+    @staticmethod
+    def _make_pristine(obj):
+        """
+        Make the copy of a freshly loaded `obj` kept in the cache. Unlike the copies handed out, it shares none of the
+        state the loader of `obj` changes, not even the symbols.
+        """
+        if obj.binary is None:
+            raise ValueError("Can't share an object loaded from a stream")
+        memo = {id(obj.memory): obj.memory.fork()}
+        if obj.compatible_with is not None:
+            memo[id(obj.compatible_with)] = None
+        for shared in (obj.arch, obj.segments, obj.sections, obj.sections_map, obj.deps,
+                       getattr(obj, '_dynamic', None), getattr(obj, '_plt', None),
+                       getattr(obj, 'demangled_names', None)):
+            if shared is not None:
+                memo[id(shared)] = shared
+        pristine = copy.deepcopy(obj, memo)
+        pristine.compatible_with = None
+        return pristine
+
+    @staticmethod
+    def _copy(obj, compatible_with):
+        """
+        Make a copy of the pristine `obj` for a loader, sharing with it everything the loader won't modify.
+        """
+        clone = _shallow_copy(obj)
+        clone.compatible_with = compatible_with
+        clone.memory = obj.memory.fork()
+        if isinstance(obj.binary_stream, PatchedStream):
+            clone.binary_stream = copy.copy(obj.binary_stream)
+            clone.binary_stream.stream = BlockCachedStream(open(obj.binary, 'rb'))
+        else:
+            clone.binary_stream = BlockCachedStream(open(obj.binary, 'rb'))
+        if hasattr(clone, '_open_tables'):
+            clone._open_tables() # pylint: disable=protected-access
+
+        bound = {} # mapping from the id of each symbol of obj to its copy bound to the clone
+        def bind(symbol):
+            if symbol is None or symbol.owner_obj is not obj:
+                return symbol
+            out = bound.get(id(symbol), None)
+            if out is None:
+                out = bound[id(symbol)] = _shallow_copy(symbol)
+                out.owner_obj = clone
+            return out
+
+        for name in ('symbols_by_addr', '_symbol_cache', '_exports'):
+            if isinstance(getattr(obj, name, None), dict):
+                setattr(clone, name, _BoundSymbols(getattr(obj, name), bind))
+        if hasattr(obj, '_nullsymbol'):
+            clone._nullsymbol = bind(obj._nullsymbol)
+        if isinstance(obj.resolved_imports, list):
+            clone.resolved_imports = [bind(symbol) for symbol in obj.resolved_imports]
+        clone.irelatives = list(obj.irelatives)
+
+        relocs = {} # mapping from the id of each relocation of obj to its copy
+        clone.relocs = [ ]
+        for reloc in obj.relocs:
+            out = relocs[id(reloc)] = _shallow_copy(reloc)
+            out.owner_obj = clone
+            out.symbol = bind(reloc.symbol)
+            clone.relocs.append(out)
+        for name in ('imports', 'jmprel'):
+            table = getattr(obj, name)
+            setattr(clone, name, type(table)((k, relocs.get(id(v), v)) for k, v in table.iteritems()))
+        return clone
+
+    def load(self, key, compatible_with=None):
+        """
+        Get a copy of an object from the cache.
+
+        :param key:             The key of the entry, from :meth:`key`
+        :param compatible_with: The object the loaded object must be compatible with, as for the backends
+        :return:                The copy, or None if the object isn't in the cache.
+        """
+        with self._lock:
+            pristine = self._objects.get(key, None)
+            if pristine is None:
+                self.misses += 1
+                return None
+            obj = self._copy(pristine, compatible_with)
+            self.hits += 1
+
+        _make_compatible(obj, compatible_with)
+        return obj
+
+    def store(self, key, obj, compatible_with=None): # pylint: disable=unused-argument
+        """
+        Put an object into the cache. It is copied, so `obj` itself can still be used by the loader that loaded it.
+        Objects that can't be copied, like the ones loaded from streams, are silently left out.
+
+        :param key:             The key of the entry, from :meth:`key`
+        :param obj:             The freshly loaded object
+        :param compatible_with: The object `obj` was loaded to be compatible with. It is left out of the entry.
+        :return:                Whether the object was cached.
+        """
+        with self._lock:
+            try:
+                self._objects[key] = self._make_pristine(obj)
+            except Exception as e: # pylint: disable=broad-except
+                l.debug("Not caching %s: %s", obj.binary, e)
+                return False
+        return True
+
+    def clear(self):
+        """
+        Drop all the objects in the cache. The copies handed out to loaders are unaffected.
+        """
+        with self._lock:
+            self._objects.clear()
+
+# the cache shared by all the loaders created with share_objects=True
+shared_object_cache = SharedObjectCache()
+
+def _shallow_copy(x):
+    out = object.__new__(type(x))
+    out.__dict__.update(x.__dict__)
+    return out
+
+class _BoundSymbols(DictMixin, object):
+    """
+    A dict of the symbols of a copy of a cached object, as a view over the same dict of the pristine object. A symbol
+    of the pristine object is copied and bound to the copy the first time it is looked up, and the symbols stored in it
+    only go in the view. It pickles as a plain dict.
+    """
+    def __init__(self, shared, bind):
+        """
+        :param dict shared: The dict of symbols of the pristine object
+        :param bind:        A function making the copy of a symbol of the pristine object bound to the copy, which
+                            gives the same copy for a symbol every time
+        """
+        self._shared = shared
+        self._bind = bind
+        self._own = {}
+        self._removed = set()
+
+    def __getitem__(self, k):
+        if k in self._own:
+            return self._own[k]
+        if k in self._removed:
+            raise KeyError(k)
+        symbol = self._own[k] = self._bind(self._shared[k])
+        return symbol
+
+    def __setitem__(self, k, v):
+        self._own[k] = v
+        self._removed.discard(k)
+
+    def __delitem__(self, k):
+        if k not in self:
+            raise KeyError(k)
+        self._own.pop(k, None)
+        self._removed.add(k)
+
+    def __contains__(self, k):
+        return k in self._own or (k in self._shared and k not in self._removed)
+
+    has_key = __contains__
+
+    def __iter__(self):
+        for k in self._shared:
+            if k not in self._own and k not in self._removed:
+                yield k
+        for k in self._own:
+            yield k
+
+    def keys(self):
+        return [k for k in self]
+
+    def bound_values(self):
+        """
+        The symbols copied for the copy or stored in it so far, without binding any more of them.
+        """
+        return self._own.values()
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __reduce__(self):
+        return dict, (dict(self.iteritems()),)
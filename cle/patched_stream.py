@@ -1,38 +1,79 @@
+import bisect
+
 class PatchedStream(object):
     """
     An object that wraps a readable stream, performing passthroughs on seek and read operations,
     except to make it seem like the data has actually been patched by the given patches.
+
+    The patches are kept as a sorted list of non-overlapping patches, so that each read only has to look at the patches
+    it overlaps.
     """
     def __init__(self, stream, patches):
         """
         :param stream:      The stream to patch
-        :param patches:     A list of tuples of (addr, patch data)
+        :param patches:     A list of tuples of (addr, patch data). Where patches overlap, the later one wins.
         """
         if type(stream) is PatchedStream:
             patches = stream.patches + patches
             stream = stream.stream
 
         self.stream = stream
-        self.patches = patches
+        self.patches = [ ]
+        self._starts = [ ]
+        for addr, patch in patches:
+            self._add_patch(addr, patch)
         self._pos = stream.tell()
 
+    def _add_patch(self, addr, patch):
+        """
+        Add a patch on top of the existing ones, cutting away the parts of them it covers.
+        """
+        end = addr + len(patch)
+        if addr >= end:
+            return
+        first = bisect.bisect_right(self._starts, addr) - 1
+        if first < 0 or self._starts[first] + len(self.patches[first][1]) <= addr:
+            first += 1
+        last = bisect.bisect_left(self._starts, end)
+
+        new = [ ]
+        if first < last:
+            old_addr, old_patch = self.patches[first]
+            if old_addr < addr:
+                new.append((old_addr, old_patch[:addr - old_addr]))
+        new.append((addr, patch))
+        if first < last:
+            old_addr, old_patch = self.patches[last - 1]
+            if old_addr + len(old_patch) > end:
+                new.append((end, old_patch[end - old_addr:]))
+        self.patches[first:last] = new
+        self._starts[first:last] = [a for a, _ in new]
+
     def read(self, *args, **kwargs):
         data = self.stream.read(*args, **kwargs)
         pos = self._pos
         newpos = pos + len(data)
+        self._pos = newpos
 
-        # AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
-        for addr, patch in self.patches:
-            if (addr >= self._pos and addr < newpos) or \
-               (self._pos >= addr and self._pos < addr + len(patch)):
-                   inject_start = max(0, addr - pos)
-                   inject_end = min(addr - pos + len(patch), len(data))
-                   patch_start = max(0, pos - addr)
-                   patch_end = min(newpos - addr, len(patch))
-                   data = data[:inject_start] + patch[patch_start:patch_end] + data[inject_end:]
+        i = bisect.bisect_right(self._starts, pos) - 1
+        if i < 0 or self._starts[i] + len(self.patches[i][1]) <= pos:
+            i += 1
+        if i == len(self.patches) or self._starts[i] >= newpos:
+            return data
 
-        self._pos = newpos
-        return data
+        pieces = [ ]
+        cur = pos
+        while i < len(self.patches) and self._starts[i] < newpos:
+            addr, patch = self.patches[i]
+            if addr > cur:
+                pieces.append(data[cur - pos:addr - pos])
+                cur = addr
+            stop = min(newpos, addr + len(patch))
+            pieces.append(patch[cur - addr:stop - addr])
+            cur = stop
+            i += 1
+        pieces.append(data[cur - pos:])
+        return ''.join(pieces)
 
     def seek(self, *args, **kwargs):
         self.stream.seek(*args, **kwargs)
@@ -143,4 +143,13 @@ class Relocation(object):
 
         self.owner_obj.memory.write_addr_at(self.dest_addr, self.value)
 
+    @property
+    def batchable(self):
+        """
+        Whether relocating this only writes `value` at `dest_addr`, without reading anything the relocations before it
+        may have written. The loader resolves these itself and writes the values of all of an object's batchable
+        relocations in one go. Subclasses that override relocate() aren't.
+        """
+        return type(self).relocate.__func__ is Relocation.relocate.__func__
+
 load_relocations()
@@ -32,6 +32,8 @@ class GenericRelativeReloc(Relocation):
         return True
 
 class GenericCopyReloc(Relocation):
+    batchable = False   # the value is read from memory
+
     @property
     def value(self):
         return self.resolvedby.owner_obj.memory.read_addr_at(self.resolvedby.addr)
@@ -13,12 +13,8 @@ class R_PPC64_JMP_SLOT(Relocation):
             # R_PPC64_JMP_SLOT
             # http://osxr.org/glibc/source/sysdeps/powerpc/powerpc64/dl-machine.h?v=glibc-2.15#0405
             # copy an entire function descriptor struct
-            addr = self.resolvedby.owner_obj.memory.read_addr_at(self.resolvedby.addr)
-            toc = self.resolvedby.owner_obj.memory.read_addr_at(self.resolvedby.addr + 8)
-            aux = self.resolvedby.owner_obj.memory.read_addr_at(self.resolvedby.addr + 16)
-            self.owner_obj.memory.write_addr_at(self.addr, addr)
-            self.owner_obj.memory.write_addr_at(self.addr + 8, toc)
-            self.owner_obj.memory.write_addr_at(self.addr + 16, aux)
+            descriptor = self.resolvedby.owner_obj.memory.read_addrs([self.resolvedby.addr + i for i in (0, 8, 16)])
+            self.owner_obj.memory.write_addrs(zip([self.addr + i for i in (0, 8, 16)], descriptor))
         else:
             self.owner_obj.memory.write_addr_at(self.addr, self.resolvedby.rebased_addr)
         return True
@@ -1,9 +1,17 @@
 
+import os
+import re
+import pickle
+import struct
+import tempfile
 import cffi
+import archinfo
 import nose.tools
 
 import cle
 
+_ffi = cffi.FFI()
+
 def test_cclemory():
     # This is a test case for C-backed Clemory.
 
@@ -35,6 +43,73 @@ def test_cclemory():
     out = c.memcmp(ffi.new("unsigned char []", "ABCDEFGH"), byte_str, 8)
     nose.tools.assert_equal(out, 0)
 
+def test_cclemory_refresh():
+    """
+    Writes and backer changes only refresh the cbackers they touch
+    """
+
+    ffi = cffi.FFI()
+    child = cle.Clemory(None)
+    child.add_backer(0, "A" * 0x100)
+    child.add_backer(0x1000, "B" * 0x100)
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0, "C" * 0x100)
+    clemory.add_backer(0x10000, child)
+    cbackers = list(clemory.cbackers)
+    nose.tools.assert_equal([start for start, _ in cbackers], [0, 0x10000, 0x11000])
+
+    # writes are patched into the existing buffers
+    child.write_bytes(0x1010, "XYZ")
+    clemory[0x20] = "W"
+    nose.tools.assert_true(clemory._needs_flattening)
+    for (_, old), (_, new) in zip(cbackers, clemory.cbackers):
+        nose.tools.assert_is(old, new)
+    nose.tools.assert_equal(ffi.buffer(clemory.cbackers[2][1], 0x14)[:], "B" * 0x10 + "XYZB")
+    nose.tools.assert_equal(ffi.buffer(clemory.cbackers[0][1], 0x22)[0x1f:], "CWC")
+
+    # a backer replaced with data of the same size is refilled in place, new backers get new buffers
+    child.update_backer(0, "D" * 0x100)
+    clemory.add_backer(0x20000, "E" * 0x10)
+    new_cbackers = clemory.cbackers
+    nose.tools.assert_equal(len(new_cbackers), 4)
+    nose.tools.assert_is(new_cbackers[1][1], cbackers[1][1])
+    nose.tools.assert_equal(ffi.buffer(new_cbackers[1][1], 4)[:], "DDDD")
+    nose.tools.assert_equal(ffi.buffer(new_cbackers[3][1], 4)[:], "EEEE")
+    nose.tools.assert_false(clemory._needs_flattening)
+
+    # many writes between flattenings only keep a few ranges around
+    for i in xrange(0x10000):
+        clemory[0x10 + i % 0x80] = "F"
+        clemory[i % 0x80 * 2] = "G"
+    nose.tools.assert_less_equal(len(clemory._dirty_ranges), cle.memory.DIRTY_RANGES_LIMIT)
+    nose.tools.assert_equal(ffi.buffer(clemory.cbackers[0][1], 0x14)[0x10:], "GFGF")
+    nose.tools.assert_equal(clemory._dirty_ranges, [ ])
+
+def test_cclemory_merged():
+    """
+    Adjacent backers are flattened into a single buffer, so C reads can cross between them
+    """
+
+    ffi = cffi.FFI()
+    child = cle.Clemory(None)
+    child.add_backer(0, "A" * 0x10)
+    child.add_backer(0x10, "B" * 0x10)
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0x100, child)
+    clemory.add_backer(0x120, "C" * 0x10)
+    clemory.add_backer(0x200, "D" * 0x10)
+
+    nose.tools.assert_equal(len(clemory.cbackers), 2)
+    ptr, size = clemory.read_bytes_c(0x118, 0x10)
+    nose.tools.assert_equal(size, 0x18)
+    nose.tools.assert_equal(ffi.buffer(ptr, 0x10)[:], "B" * 8 + "C" * 8)
+    nose.tools.assert_raises(KeyError, clemory.read_bytes_c, 0x118, 0x20)
+    nose.tools.assert_raises(KeyError, clemory.read_bytes_c, 0x130)
+
+    clemory.write_bytes(0x11e, "XXXX")
+    ptr, _ = clemory.read_bytes_c(0x118, 0x10)
+    nose.tools.assert_equal(ffi.buffer(ptr, 0x10)[:], "B" * 6 + "XXXX" + "C" * 6)
+
 def test_clemory():
     """
     Some basic tests of the Clemory class
@@ -63,11 +138,657 @@ def test_clemory():
     nose.tools.assert_equal(len(clemory._backers), 3)
     nose.tools.assert_equal("".join(clemory.read_bytes(0, 25)), "B" * 10 + "A" * 15)
 
+def test_backer_lookup():
+    """
+    Lookups through the backer index, including nested Clemorys with holes in them
+    """
+
+    clemory = cle.Clemory(None, root=True)
+    for i in xrange(100):
+        clemory.add_backer(0x1000 * i, chr(0x41 + i % 26) * 0x100)
+
+    nose.tools.assert_equal(clemory[0x1000 * 42 + 0x80], 'Q')
+    nose.tools.assert_in(0x1000 * 99 + 0xff, clemory)
+    nose.tools.assert_not_in(0x1000 * 99 + 0x100, clemory)
+    nose.tools.assert_not_in(0x1000 * 42 + 0x100, clemory)
+
+    child = cle.Clemory(None)
+    child.add_backer(0, "A" * 0x10)
+    child.add_backer(0x20, "B" * 0x10)
+    clemory.add_backer(0x200000, child)
+    nose.tools.assert_equal(clemory[0x200025], 'B')
+    nose.tools.assert_not_in(0x200015, clemory)
+
+    # changes to the layout of a child are visible through the parent
+    child.add_backer(0x100, "C" * 0x10)
+    nose.tools.assert_equal(clemory[0x200105], 'C')
+    child.remove_backer(0x20)
+    nose.tools.assert_not_in(0x200025, clemory)
+
+def test_leaf_table():
+    """
+    The flattened table of leaf backers, and how it resolves overlapping backers
+    """
+
+    child = cle.Clemory(None)
+    child.add_backer(0, "A" * 0x10)
+    child.add_backer(0x40, "B" * 0x10)
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0x100, child)
+    clemory.add_backer(0x110, "P" * 0x80)
+    clemory.add_backer(0x80, "Q" * 0x88)
+
+    expected = "Q" * 0x88 + "A" * 8 + "P" * 0x30 + "B" * 0x10 + "P" * 0x40
+    nose.tools.assert_equal(clemory.read_bytes(0x80, 0x110), expected)
+    nose.tools.assert_equal(''.join(clemory[k] for k in clemory), expected)
+    nose.tools.assert_equal(clemory._extents(), [(0x80, 0x190)])
+
+    leaves = clemory._leaves
+    clemory.write_bytes(0x10c, "CC")
+    nose.tools.assert_equal(child.read_bytes(0xc, 2), "CC")
+    nose.tools.assert_is(clemory._leaves, leaves)
+
+    # only changes to the layout of the backers invalidate it
+    child.add_backer(0x100, "D" * 0x10)
+    nose.tools.assert_is_none(clemory._leaves)
+    nose.tools.assert_equal(clemory.read_bytes(0x200, 4), "DDDD")
+    nose.tools.assert_not_in(0x1ff, clemory)
+
+def test_iter_extents():
+    """
+    Iterating over the contiguous and the modified regions of memory
+    """
+
+    child = cle.Clemory(None)
+    child.add_backer(0, "A" * 0x1000)
+    child.add_backer(0x1000, "B" * 0x1000)
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0x10000, child)
+    clemory.add_backer(0x12000, "C" * 0x800)
+    clemory.add_backer(0x20000, "D" * 0x10)
+
+    extents = [(lo, hi, data.tobytes()) for lo, hi, data in clemory.iter_extents()]
+    nose.tools.assert_equal(extents, [(0x10000, 0x12800, "A" * 0x1000 + "B" * 0x1000 + "C" * 0x800),
+                                      (0x20000, 0x20010, "D" * 0x10)])
+    nose.tools.assert_equal(list(clemory.iter_dirty_extents()), [ ])
+
+    clemory.write_bytes(0x11ffe, "EEEE")
+    clemory[0x20004] = "F"
+    dirty = [(lo, hi, data.tobytes()) for lo, hi, data in clemory.iter_dirty_extents()]
+    nose.tools.assert_equal(dirty, [(0x11000, 0x12800, "B" * 0xffe + "EEEE" + "C" * 0x7fe),
+                                    (0x20000, 0x20010, "DDDDFDDDDDDDDDDD")])
+    nose.tools.assert_equal(list(clemory.iter_extents(orig=True))[0][2].tobytes()[0x1ffe:0x2002], "BBCC")
+
+def test_stream():
+    """
+    File-like streams over a Clemory, each with its own position
+    """
+
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0, "ABCDEFGH")
+    clemory.add_backer(8, "IJKL")
+    clemory.add_backer(0x20, "MNOP")
+    clemory[1] = "b"
+
+    stream1 = cle.ClemoryStream(clemory)
+    stream2 = cle.ClemoryStream(clemory, 0x20)
+    stream1.seek(0)
+    nose.tools.assert_equal(stream1.read(2), "Ab")
+    nose.tools.assert_equal(stream2.read(2), "MN")
+    nose.tools.assert_equal(stream1.read(1), "C")
+    nose.tools.assert_equal(stream1.tell(), 3)
+
+    # reads stop at the end of the backed memory, like at the end of a file, but can't start past it
+    stream1.seek(6)
+    nose.tools.assert_equal(stream1.read(0x10), "GHIJKL")
+    nose.tools.assert_raises(KeyError, stream1.read, 0x10)
+    nose.tools.assert_raises(KeyError, stream1.readinto, bytearray(4))
+    nose.tools.assert_equal(stream1.tell(), 12)
+    nose.tools.assert_equal(stream1.read(0), "")
+    stream1.seek(-4, 2)
+    nose.tools.assert_equal(stream1.read(), "MNOP")
+
+    buf = bytearray(6)
+    stream1.seek(4)
+    nose.tools.assert_equal(stream1.readinto(buf), 6)
+    nose.tools.assert_equal(buf, "EFGHIJ")
+    stream1.seek(-2, 1)
+    nose.tools.assert_equal(stream1.readinto(buf), 4)
+    nose.tools.assert_equal(buf[:4], "IJKL")
+
+def test_checkpoints():
+    """
+    The journal of changes since a checkpoint, and rolling back to checkpoints
+    """
+
+    child = cle.Clemory(None)
+    child.add_backer(0, "A" * 0x2000)
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0, "B" * 0x100)
+    clemory.add_backer(0x1000, child)
+    clemory.write_bytes(0x10, "CC")
+    clemory.cbackers # pylint: disable=pointless-statement
+
+    # tokens only mean something to the memory that handed them out, the child is asked through a checkpoint of its own
+    own = child.checkpoint()
+    first = clemory.checkpoint()
+    clemory.write_bytes(0x20, "DD")
+    clemory.write_bytes(0x22, "DD")
+    clemory.write_bytes(0x1100, "EE")
+    child.write_bytes_to_backer(0x200, "FF")
+    nose.tools.assert_equal(clemory.changes_since(first), [(0x20, 0x24), (0x1100, 0x1102), (0x1200, 0x1202)])
+    nose.tools.assert_equal(child.changes_since(own), [(0x100, 0x102), (0x200, 0x202)])
+
+    second = clemory.checkpoint()
+    nose.tools.assert_equal(clemory.changes_since(second), [ ])
+    clemory.add_backer(0x4000, "G" * 0x10)
+    clemory.write_bytes(0x21, "H")
+    nose.tools.assert_equal(clemory.changes_since(second), [(0x21, 0x22), (0x4000, 0x4010)])
+    nose.tools.assert_equal(clemory.changes_since(first)[0], (0x20, 0x24))
+
+    clemory.rollback(second)
+    nose.tools.assert_equal(clemory.changes_since(second), [ ])
+    nose.tools.assert_not_in(0x4000, clemory)
+    nose.tools.assert_equal(clemory.read_bytes(0x20, 4), "DDDD")
+
+    clemory.rollback(first)
+    nose.tools.assert_raises(KeyError, clemory.changes_since, second)
+    nose.tools.assert_equal(clemory.read_bytes(0x1e, 8), "B" * 8)
+    nose.tools.assert_equal(clemory.read_bytes(0x10, 2), "CC")
+    nose.tools.assert_equal(clemory.read_bytes(0x1100, 2), "AA")
+    nose.tools.assert_equal(clemory.read_bytes(0x1200, 2), "AA")
+    nose.tools.assert_equal(_ffi.buffer(clemory.cbackers[0][1], 0x24)[0x10:], "CC" + "B" * 0x12)
+    nose.tools.assert_equal(_ffi.buffer(clemory.cbackers[1][1], 0x202)[0x1fe:], "AAAA")
+
+    # scattered writes don't pile up in the journal, and are still all reported
+    third = clemory.checkpoint()
+    for i in xrange(0x10000):
+        clemory[i % 0x80 * 2] = "I"
+    nose.tools.assert_less_equal(len(clemory._journal), cle.memory.DIRTY_RANGES_LIMIT + 1)
+    nose.tools.assert_equal(clemory.changes_since(third), [(i, i + 1) for i in xrange(0, 0x100, 2)])
+    nose.tools.assert_equal(clemory.changes_since(first)[-1], (0xfe, 0xff))
+    clemory.rollback(third)
+    nose.tools.assert_equal(clemory.read_bytes(0, 2), "BB")
+    clemory.release_checkpoint(third)
+
+    clemory.release_checkpoint(first)
+    nose.tools.assert_equal(clemory._journal, [ ])
+    nose.tools.assert_equal(child.changes_since(own), [ ]) # the rollback of the root undid them
+    child.release_checkpoint(own)
+    nose.tools.assert_equal(child._checkpoints, { })
+
+def test_footprint():
+    """
+    Accounting for the memory held by a Clemory
+    """
+
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_clemory.py')
+    child = cle.Clemory(None)
+    child.add_backer(0, "A" * 0x100)
+    child.add_backer(0x100, cle.FileBacker(path, 0, 0x80, 0x100))
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0, bytearray(0x10))
+    clemory.add_backer(0x1000, child)
+
+    footprint = clemory.footprint()
+    nose.tools.assert_equal(footprint['backers'], 0x110)
+    nose.tools.assert_equal(footprint['mapped'], 0x80)
+    nose.tools.assert_equal(footprint['updates'], 0)
+    nose.tools.assert_equal(footprint['per_backer'], [(0, 'bytearray', 0x10), (0x1000, 'str', 0x100),
+                                                      (0x1100, 'file', 0x80)])
+
+    clemory.write_bytes(0x1000, "B")
+    clemory.write_bytes(0, "B")
+    nose.tools.assert_equal(len(clemory.cbackers), 2)
+    footprint = clemory.footprint()
+    nose.tools.assert_equal(footprint['updates'], 2 * cle.memory.PAGE_SIZE)
+    nose.tools.assert_equal(footprint['cbackers'], 0x210)
+
+def test_permissions():
+    """
+    The permission map of a Clemory
+    """
+
+    R, W, X = cle.PERM_READ, cle.PERM_WRITE, cle.PERM_EXEC
+    clemory = cle.Clemory(None, root=True)
+    clemory.set_permissions(0x1000, 0x3000, R | X)
+    clemory.set_permissions(0x3000, 0x4000, R)
+    clemory.set_permissions(0x5000, 0x6000, R | W)
+
+    nose.tools.assert_equal(clemory.permissions(0x1000), R | X)
+    nose.tools.assert_equal(clemory.permissions(0x3fff), R)
+    nose.tools.assert_is_none(clemory.permissions(0x4000))
+    nose.tools.assert_is_none(clemory.permissions(0xfff))
+
+    # setting permissions splits the regions they overlap
+    clemory.set_permissions(0x2000, 0x3800, R | W)
+    nose.tools.assert_equal(clemory.permission_regions(),
+                            [(0x1000, 0x2000, R | X), (0x2000, 0x3800, R | W), (0x3800, 0x4000, R),
+                             (0x5000, 0x6000, R | W)])
+    clemory.set_permissions(0x1800, 0x1900, R | W)
+    nose.tools.assert_equal(clemory.permission_regions(0x1000, 0x2800),
+                            [(0x1000, 0x1800, R | X), (0x1800, 0x1900, R | W), (0x1900, 0x2000, R | X),
+                             (0x2000, 0x2800, R | W)])
+    nose.tools.assert_equal(clemory.permission_regions(permissions=W),
+                            [(0x1800, 0x1900, R | W), (0x2000, 0x3800, R | W), (0x5000, 0x6000, R | W)])
+
+    # adjacent regions with the same permissions are merged
+    clemory.set_permissions(0x4000, 0x5000, R | W)
+    nose.tools.assert_equal(clemory.permission_regions(0x3000), [(0x3000, 0x3800, R | W), (0x3800, 0x4000, R),
+                                                                 (0x4000, 0x6000, R | W)])
+
+def test_read_bytes():
+    """
+    Bulk reads across adjacent and nested backers, with updates on top
+    """
+
+    child = cle.Clemory(None)
+    child.add_backer(0, "0123456789")
+    child.add_backer(10, "abcdef")
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0, "ABCD")
+    clemory.add_backer(4, child)
+
+    nose.tools.assert_equal(clemory.read_bytes(2, 16), "CD0123456789abcd")
+    child[5] = 'X'
+    clemory[1] = 'Y'
+    nose.tools.assert_equal(clemory.read_bytes(0, 20), "AYCD01234X6789abcdef")
+    nose.tools.assert_equal(clemory.read_bytes(0, 20, orig=True), "ABCD0123456789abcdef")
+    nose.tools.assert_raises(KeyError, clemory.read_bytes, 10, 20)
+
+def test_update_pages():
+    """
+    Updates are stored as copy-on-write pages over the backers
+    """
+
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0, "A" * 0x2000)
+    child = cle.Clemory(None)
+    child.add_backer(0, "C" * 0x100)
+    clemory.add_backer(0x2000, child)
+
+    # a write spanning two pages
+    clemory.write_bytes(0xffe, "BBBB")
+    nose.tools.assert_equal(sorted(clemory._updates), [0, 1])
+    nose.tools.assert_equal(clemory.read_bytes(0xffc, 8), "AABBBBAA")
+    nose.tools.assert_equal(clemory.read_bytes(0xffc, 8, orig=True), "A" * 8)
+    nose.tools.assert_equal(clemory.get_byte(0x1000), "B")
+
+    # writes to a nested memory end up in its own pages
+    clemory.write_bytes(0x1ffe, "DDDD")
+    nose.tools.assert_equal(clemory.read_bytes(0x1ffc, 8), "AADDDDCC")
+    nose.tools.assert_equal(child.read_bytes(0, 4), "DDCC")
+    nose.tools.assert_equal(child.read_bytes(0, 4, orig=True), "CCCC")
+    nose.tools.assert_raises(IndexError, clemory.write_bytes, 0x20fe, "EEEE")
+
+    # writing to the backer replaces what was written before
+    clemory.write_bytes_to_backer(0xfff, "XX")
+    nose.tools.assert_equal(clemory.read_bytes(0xffc, 8), "AABXXBAA")
+    nose.tools.assert_equal(clemory.read_bytes(0xffc, 8, orig=True), "AAAXXAAA")
+
+def test_read_view():
+    """
+    Views of clean ranges point into the backers, everything else is copied
+    """
+
+    backer = "0123456789abcdef"
+    child = cle.Clemory(None)
+    child.add_backer(0, backer)
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0x100, child)
+    clemory.add_backer(0x110, "ghij")
+
+    view = clemory.read_view(0x104, 4)
+    nose.tools.assert_equal(view.tobytes(), "4567")
+    nose.tools.assert_true(view.readonly)
+
+    nose.tools.assert_equal(clemory.read_view(0x10e, 4).tobytes(), "efgh")
+    child[5] = "X"
+    nose.tools.assert_equal(clemory.read_view(0x104, 4).tobytes(), "4X67")
+    nose.tools.assert_equal(clemory.read_view(0x104, 4, orig=True).tobytes(), "4567")
+    nose.tools.assert_raises(KeyError, clemory.read_view, 0x112, 4)
+
+    # bytearray backers can change under a view, so they are copied
+    clemory.write_bytes_to_backer(0x110, "k")
+    fork = clemory.fork()
+    view = fork.read_view(0x110, 4)
+    nose.tools.assert_true(view.readonly)
+    fork.write_bytes_to_backer(0x110, "l")
+    nose.tools.assert_equal(view.tobytes(), "khij")
+    nose.tools.assert_equal(clemory.read_bytes(0x110, 4), "khij")
+
+def test_file_backer():
+    """
+    Backers mapped from a file, with an implicit zero-filled tail
+    """
+
+    path = os.path.realpath(__file__).replace('.pyc', '.py')
+    with open(path, 'rb') as f:
+        contents = f.read()
+
+    backer = cle.FileBacker(path, 0x10, 0x20, 0x30)
+    nose.tools.assert_equal(len(backer), 0x30)
+    nose.tools.assert_equal(backer[0x18:0x28], contents[0x28:0x30] + "\0" * 8)
+
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0x1000, backer)
+    nose.tools.assert_equal(clemory.read_bytes(0x1000, 0x30), contents[0x10:0x30] + "\0" * 0x10)
+    nose.tools.assert_equal(clemory[0x102f], "\0")
+    view = clemory.read_view(0x1004, 8)
+    nose.tools.assert_equal(view.tobytes(), contents[0x14:0x1c])
+    nose.tools.assert_true(view.readonly)
+
+    clemory.write_bytes(0x101e, "ABCD")
+    nose.tools.assert_equal(clemory.read_bytes(0x101c, 8), contents[0x2c:0x2e] + "ABCD" + "\0\0")
+    nose.tools.assert_equal(clemory.read_bytes(0x101c, 8, orig=True), contents[0x2c:0x30] + "\0" * 4)
+
+def test_file_backer_changed():
+    """
+    File backers refuse to map a file that changed since they were made
+    """
+
+    fd, path = tempfile.mkstemp()
+    try:
+        os.write(fd, "A" * 0x100)
+        os.close(fd)
+        backer = cle.FileBacker(path, 0, 0x100)
+        os.utime(path, (0, 0))
+        nose.tools.assert_raises(cle.CLEError, backer.__getitem__, 0)
+
+        backer = cle.FileBacker(path, 0, 0x100)
+        nose.tools.assert_equal(backer[0:4], "AAAA")
+    finally:
+        os.unlink(path)
+
+def test_zero_backer():
+    """
+    Zero-filled backers that only take memory where they are written to
+    """
+
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0, "A" * 0x10)
+    clemory.add_backer(0x10, cle.ZeroBacker(0x100000))
+    nose.tools.assert_equal(len(clemory.cbackers), 1)
+
+    nose.tools.assert_equal(clemory.read_bytes(0xe, 4), "AA\0\0")
+    nose.tools.assert_equal(clemory[0x10000f], "\0")
+    nose.tools.assert_not_in(0x100010, clemory)
+    nose.tools.assert_equal(clemory.read_view(0x20, 0x10).tobytes(), "\0" * 0x10)
+
+    clemory.write_bytes(0x80010, "BB")
+    nose.tools.assert_equal(clemory.read_bytes(0x8000f, 4), "\0BB\0")
+    nose.tools.assert_equal(clemory.read_bytes(0x8000f, 4, orig=True), "\0" * 4)
+    nose.tools.assert_equal(sorted(clemory._updates), [0x80])
+    nose.tools.assert_equal(clemory.footprint()['backers'], 0x10)
+    nose.tools.assert_equal(_ffi.buffer(clemory.cbackers[0][1], 0x80013)[0x8000f:], "\0BB\0")
+
+def test_file_backer_pickle():
+    """
+    Pickled file backers refer to the file instead of holding its contents
+    """
+
+    fd, path = tempfile.mkstemp()
+    try:
+        os.write(fd, "A" * 0x10000)
+        os.close(fd)
+
+        clemory = cle.Clemory(None, root=True)
+        clemory.add_backer(0, cle.FileBacker(path, 0, 0x10000))
+        clemory.write_bytes(0x10, "B")
+        data = pickle.dumps(clemory, pickle.HIGHEST_PROTOCOL)
+        nose.tools.assert_less(len(data), 0x2000)
+
+        clemory = pickle.loads(data)
+        nose.tools.assert_equal(clemory.read_bytes(0xe, 4), "AABA")
+
+        # the file is checked against the hash once it's mapped again
+        broken = pickle.loads(data)
+        with open(path, 'r+b') as f:
+            f.write("C")
+        nose.tools.assert_raises(cle.CLEError, broken.read_bytes, 0x20, 4)
+    finally:
+        os.unlink(path)
+
+def test_file_string_pickle():
+    """
+    Strings read from a file are pickled as references to it too
+    """
+
+    fd, path = tempfile.mkstemp()
+    try:
+        os.write(fd, "A" * 0x10 + "B" * 0x10000)
+        os.close(fd)
+
+        with open(path, 'rb') as f:
+            f.seek(0x10)
+            backer = cle.FileString(f.read(0x10000), path, 0x10)
+        clemory = cle.Clemory(None, root=True)
+        clemory.add_backer(0, backer)
+        clemory.write_bytes(0x10, "C")
+        nose.tools.assert_equal(clemory.footprint()['per_backer'], [(0, 'str', 0x10000)])
+        data = pickle.dumps(clemory, pickle.HIGHEST_PROTOCOL)
+        nose.tools.assert_less(len(data), 0x2000)
+
+        clemory = pickle.loads(data)
+        nose.tools.assert_equal(clemory.read_bytes(0xe, 4), "BBCB")
+        nose.tools.assert_equal(clemory.read_bytes(0xe, 4, orig=True), "BBBB")
+
+        # the file is checked against the hash when the string is unpickled
+        with open(path, 'r+b') as f:
+            f.seek(0x20)
+            f.write("D")
+        nose.tools.assert_raises(cle.CLEError, pickle.loads, data)
+    finally:
+        os.unlink(path)
+
+def test_addrs():
+    """
+    Batched pointer reads and writes
+    """
+
+    clemory = cle.Clemory(archinfo.ArchAMD64(), root=True)
+    clemory.add_backer(0, "\0" * 0x40)
+    clemory.add_backer(0x100, "\0" * 0x10)
+
+    clemory.write_addrs([(0x8, 0x1122334455667788), (0x10, 2), (0x18, -1), (0x100, 3), (0x0, 4)])
+    nose.tools.assert_equal(clemory.read_bytes(0x8, 0x10), "\x88\x77\x66\x55\x44\x33\x22\x11\x02" + "\0" * 7)
+    nose.tools.assert_equal(clemory.read_addrs([0x100, 0x0, 0x8, 0x10, 0x18, 0x20]),
+                            [3, 4, 0x1122334455667788, 2, 0xffffffffffffffff, 0])
+    nose.tools.assert_equal(clemory.read_addrs(range(0, 0x20, 8)), [4, 0x1122334455667788, 2, 0xffffffffffffffff])
+    nose.tools.assert_raises(KeyError, clemory.read_addrs, [0x38, 0x40])
+
+    clemory = cle.Clemory(archinfo.ArchPPC32('Iend_BE'), root=True)
+    clemory.add_backer(0, "\0" * 0x10)
+    clemory.write_addrs([(0, 0x11223344), (4, 0x55667788)])
+    nose.tools.assert_equal(clemory.read_bytes(0, 8), "\x11\x22\x33\x44\x55\x66\x77\x88")
+    nose.tools.assert_equal(clemory.read_addrs([4, 0]), [0x55667788, 0x11223344])
+
+    # runs of any length don't leave precompiled structs behind
+    structs = len(cle.memory._structs)
+    clemory.read_addrs([0, 4, 8])
+    clemory.write_addrs([(0, 1), (4, 2), (8, 3), (12, 4)])
+    nose.tools.assert_equal(len(cle.memory._structs), structs)
+
+def check_read_array(numpy):
+    cle.memory.numpy, old_numpy = numpy, cle.memory.numpy
+    try:
+        _check_read_array()
+    finally:
+        cle.memory.numpy = old_numpy
+
+def _check_read_array():
+    clemory = cle.Clemory(archinfo.ArchAMD64(), root=True)
+    clemory.add_backer(0, "\x01\0\0\0\x02\0\0\0\x03\0\0\0\x04\0\0\0")
+    clemory.add_backer(0x10, cle.ZeroBacker(0x10))
+    nose.tools.assert_equal(list(clemory.read_array(0, 4, 'I')), [1, 2, 3, 4])
+    nose.tools.assert_equal(list(clemory.read_array(0x10, 2)), [0, 0])
+    nose.tools.assert_equal(list(clemory.read_array(0xc, 3, 'I')), [4, 0, 0])
+    nose.tools.assert_equal(list(clemory.read_array(0, 2)), [0x200000001, 0x400000003])
+    nose.tools.assert_equal(list(clemory.read_array(0, 2, 'I', 'Iend_BE')), [0x1000000, 0x2000000])
+    nose.tools.assert_equal(list(clemory.read_array(4, 2, 'H')), [2, 0])
+
+    clemory[8] = "\xff"
+    nose.tools.assert_equal(list(clemory.read_array(4, 3, 'I')), [2, 0xff, 4])
+    nose.tools.assert_equal(list(clemory.read_array(4, 3, 'i', orig=True)), [2, 3, 4])
+    nose.tools.assert_raises(KeyError, clemory.read_array, 0x18, 3, 'I')
+
+    path = os.path.realpath(__file__).replace('.pyc', '.py')
+    with open(path, 'rb') as f:
+        contents = f.read(0x10)
+    clemory.add_backer(0x100, cle.FileBacker(path, 0, 0x10))
+    nose.tools.assert_equal(list(clemory.read_array(0x100, 4, 'I')), list(struct.unpack('<4I', contents)))
+
+def test_read_array():
+    """
+    Typed arrays of integers out of memory, as numpy arrays if numpy is installed and as array.arrays if it isn't
+    """
+
+    if cle.memory.numpy is not None:
+        yield check_read_array, cle.memory.numpy
+    yield check_read_array, None
+
+def test_find():
+    """
+    Searching memory for literal, masked and regex patterns
+    """
+
+    child = cle.Clemory(None)
+    child.add_backer(0, "xxABC")
+    child.add_backer(5, "DEFxxABCD")
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0x100, "ABCDxx")
+    clemory.add_backer(0x106, child)
+    clemory.add_backer(0x200, "AAAA")
+
+    nose.tools.assert_equal(list(clemory.find("ABCD")), [0x100, 0x108, 0x110])
+    nose.tools.assert_equal(list(clemory.find("ABCD", start=0x101, end=0x112)), [0x108])
+    nose.tools.assert_equal(list(clemory.find("AA")), [0x200, 0x201, 0x202])
+    nose.tools.assert_equal(list(clemory.find("xA")), [0x107, 0x10f])
+    nose.tools.assert_equal(list(clemory.find("DA")), [])
+
+    clemory.write_bytes(0x10a, "X")
+    nose.tools.assert_equal(list(clemory.find("ABCD")), [0x100, 0x110])
+    nose.tools.assert_equal(list(clemory.find("ABCD", orig=True)), [0x100, 0x108, 0x110])
+
+    nose.tools.assert_equal(list(clemory.find("A\0C", mask="\xff\0\xff")), [0x100, 0x110])
+    nose.tools.assert_equal(list(clemory.find("@", mask="\xfc")), [0x100, 0x101, 0x102, 0x108, 0x109, 0x110,
+                                                                   0x111, 0x112, 0x200, 0x201, 0x202, 0x203])
+    nose.tools.assert_equal(list(clemory.find(re.compile("x+A"))), [0x104, 0x10e])
+    nose.tools.assert_raises(ValueError, list, clemory.find("AB", mask="\xff"))
+
+    # matches that straddle the chunks the search is done in
+    old_chunk_size = cle.memory.FIND_CHUNK_SIZE
+    try:
+        cle.memory.FIND_CHUNK_SIZE = 3
+        nose.tools.assert_equal(list(clemory.find("ABCD")), [0x100, 0x110])
+        nose.tools.assert_equal(list(clemory.find("AA")), [0x200, 0x201, 0x202])
+    finally:
+        cle.memory.FIND_CHUNK_SIZE = old_chunk_size
+
+def test_fork():
+    """
+    Forked memories share their backers and pages, but not their writes
+    """
+
+    child = cle.Clemory(None)
+    child.add_backer(0, "A" * 0x2000)
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0, "B" * 0x100)
+    clemory.add_backer(0x1000, child)
+    clemory.write_bytes(0x10, "CC")
+    clemory.write_bytes(0x1010, "DD")
+
+    fork = clemory.fork()
+    nose.tools.assert_is(fork._backers[0][1], clemory._backers[0][1])
+    fork_child = fork._backers[1][1]
+    nose.tools.assert_is_not(fork_child, child)
+    nose.tools.assert_is(fork_child._updates[0], child._updates[0])
+    nose.tools.assert_equal(fork.read_bytes(0xe, 6), "BBCCBB")
+    nose.tools.assert_equal(fork.read_bytes(0x100e, 6), "AADDAA")
+
+    fork.write_bytes(0x10, "EE")
+    fork.write_bytes(0x1011, "F")
+    clemory.write_bytes(0x1010, "G")
+    nose.tools.assert_equal(clemory.read_bytes(0x10, 2), "CC")
+    nose.tools.assert_equal(clemory.read_bytes(0x1010, 2), "GD")
+    nose.tools.assert_equal(fork.read_bytes(0x10, 2), "EE")
+    nose.tools.assert_equal(fork.read_bytes(0x1010, 2), "DF")
+
+    # the layouts are independent too
+    fork.add_backer(0x4000, "H" * 0x10)
+    fork_child.add_backer(0x2000, "I" * 0x10)
+    nose.tools.assert_equal(fork.read_bytes(0x2ffe, 4), "AAII")
+    nose.tools.assert_not_in(0x4000, clemory)
+    nose.tools.assert_not_in(0x3000, clemory)
+    nose.tools.assert_equal(len(fork.cbackers), 3)
+    nose.tools.assert_equal(len(clemory.cbackers), 2)
+
+def test_write_bytes_to_backer():
+    """
+    Writes to the backers happen in place, in bytearrays owned by the memory
+    """
+
+    data = "A" * 0x100
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0, data)
+    clemory.add_backer(0x200, bytearray("B" * 0x100))
+    cbackers = clemory.cbackers
+
+    clemory.write_bytes_to_backer(0x10, "CC")
+    backer = clemory._backers[0][1]
+    nose.tools.assert_is_instance(backer, bytearray)
+    nose.tools.assert_equal(data, "A" * 0x100)
+    clemory.write_bytes_to_backer(0x20, "DD")
+    nose.tools.assert_is(clemory._backers[0][1], backer)
+    nose.tools.assert_equal(clemory.read_bytes(0xe, 0x16), "AACC" + "A" * 14 + "DDAA")
+    nose.tools.assert_equal(clemory.get_byte(0x21, orig=True), "D")
+    nose.tools.assert_equal(_ffi.buffer(clemory.cbackers[0][1], 0x22)[0x10:], "CC" + "A" * 14 + "DD")
+    nose.tools.assert_is(clemory.cbackers[0][1], cbackers[0][1])
+
+    # holes are filled with new backers, and writing past the end extends the last backer
+    clemory.write_bytes_to_backer(0xfe, "E" * 0x104)
+    nose.tools.assert_equal(len(clemory._backers), 3)
+    clemory.write_bytes_to_backer(0x2fe, "FFFF")
+    nose.tools.assert_equal(len(clemory._backers), 3)
+    nose.tools.assert_equal(len(clemory._backers[2][1]), 0x102)
+    nose.tools.assert_equal(clemory.read_bytes(0x1fe, 4), "EEEE")
+    nose.tools.assert_equal(clemory.read_bytes(0x2fc, 6), "BBFFFF")
+    nose.tools.assert_equal(len(clemory.cbackers), 1)
+
+    # a fork doesn't see the writes to the backers of the other
+    fork = clemory.fork()
+    fork.write_bytes_to_backer(0, "G")
+    clemory.write_bytes_to_backer(1, "H")
+    nose.tools.assert_equal(fork.read_bytes(0, 2), "GA")
+    nose.tools.assert_equal(clemory.read_bytes(0, 2), "AH")
+
+    # only the written pages of file and zero backers are copied, into backers of their own
+    path = os.path.realpath(__file__).replace('.pyc', '.py')
+    with open(path, 'rb') as f:
+        contents = f.read(0x3000)
+    clemory = cle.Clemory(None, root=True)
+    clemory.add_backer(0x10000, cle.FileBacker(path, 0, 0x3000, 0x4000))
+    clemory.add_backer(0x20000, cle.ZeroBacker(0x100000))
+    clemory.write_bytes_to_backer(0x21001, "I")
+    clemory.write_bytes_to_backer(0x11ffe, "JJJJ")
+    clemory.write_bytes_to_backer(0x13ffe, "KK")
+    nose.tools.assert_equal(clemory.footprint()['backers'], 0x4000)
+    nose.tools.assert_equal([(start, type(data)) for start, data in clemory._backers],
+                            [(0x10000, cle.FileBacker), (0x11000, bytearray), (0x13000, bytearray),
+                             (0x20000, cle.ZeroBacker), (0x21000, bytearray), (0x22000, cle.ZeroBacker)])
+    nose.tools.assert_equal(clemory.read_bytes(0x20fff, 4, orig=True), "\0\0I\0")
+    nose.tools.assert_equal(clemory.read_bytes(0x11ffc, 8), contents[0x1ffc:0x1ffe] + "JJJJ" + contents[0x2002:0x2004])
+    nose.tools.assert_equal(clemory.read_bytes(0x12ffe, 4), contents[0x2ffe:0x3000] + "\0\0")
+    nose.tools.assert_equal(clemory.read_bytes(0x13ffc, 4), "\0\0KK")
+    nose.tools.assert_not_in(0x14000, clemory)
+    nose.tools.assert_equal(clemory.read_bytes(0x11ff0, 0x20), clemory.read_bytes(0x11ff0, 0x20, orig=True))
+
 def main():
     g = globals()
     for func_name, func in g.iteritems():
         if func_name.startswith('test_') and hasattr(func, '__call__'):
-            func()
+            for test in func() or ():
+                test[0](*test[1:])
 
 if __name__ == "__main__":
     main()
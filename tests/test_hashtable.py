@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+import os
+import nose
+import cle
+
+test_location = str(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../binaries/tests'))
+
+def test_gnu_hash():
+    ld = cle.Loader(os.path.join(test_location, "x86_64", "libc.so.6"), auto_load_libs=False)
+    libc = ld.main_bin
+    nose.tools.assert_is_instance(libc.hashtable, cle.backends.elf.GNUHashTable)
+
+    nose.tools.assert_equal(libc.hashtable.get('strcmp').name, 'strcmp')
+    nose.tools.assert_equal(libc.get_symbol('strcmp').name, 'strcmp')
+
+    # missing symbols walk to the end of their chain, and no further
+    nose.tools.assert_is_none(libc.hashtable.get('strcmp_but_missing'))
+    nose.tools.assert_is_none(libc.get_symbol('this_symbol_does_not_exist'))
+
+if __name__ == '__main__':
+    test_gnu_hash()
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+import os
+import nose
+import cle
+
+test_location = str(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../binaries/tests'))
+
+def test_load_processes():
+    filepath = os.path.join(test_location, "x86_64", "fauxware")
+
+    serial_ld = cle.Loader(filepath)
+    parallel_ld = cle.Loader(filepath, load_processes=4)
+
+    # the libraries should be added in the same order and at the same addresses
+    nose.tools.assert_equal([(o.binary, o.rebase_addr) for o in serial_ld.all_objects],
+                            [(o.binary, o.rebase_addr) for o in parallel_ld.all_objects])
+    nose.tools.assert_equal(serial_ld.shared_objects.keys(), parallel_ld.shared_objects.keys())
+    nose.tools.assert_equal(serial_ld.memory.read_addr_at(0x601018), parallel_ld.memory.read_addr_at(0x601018))
+
+if __name__ == '__main__':
+    test_load_processes()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+import os
+import nose
+import cle
+
+test_location = str(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../binaries/tests'))
+
+def _file_backers(obj):
+    return [data for _, _, _, data in obj.memory._leaf_backers() if isinstance(data, cle.FileBacker)]
+
+def test_map_file():
+    filepath = os.path.join(test_location, "x86_64", "fauxware")
+
+    read_ld = cle.Loader(filepath)
+    mapped_ld = cle.Loader(filepath, map_file=True, lib_opts={'ld-linux-x86-64.so.2': {'map_file': False}})
+
+    # the loader-wide option reaches the libraries too, unless their own options say otherwise
+    nose.tools.assert_true(_file_backers(mapped_ld.main_bin))
+    nose.tools.assert_true(_file_backers(mapped_ld.shared_objects['libc.so.6']))
+    nose.tools.assert_false(_file_backers(mapped_ld.shared_objects['ld-linux-x86-64.so.2']))
+    nose.tools.assert_false(_file_backers(read_ld.shared_objects['libc.so.6']))
+
+    nose.tools.assert_equal([(o.binary, o.rebase_addr) for o in read_ld.all_objects],
+                            [(o.binary, o.rebase_addr) for o in mapped_ld.all_objects])
+    nose.tools.assert_equal(read_ld.memory.read_addr_at(0x601018), mapped_ld.memory.read_addr_at(0x601018))
+
+if __name__ == '__main__':
+    test_map_file()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import nose
+import cle
+
+test_location = str(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../binaries/tests'))
+
+def test_object_cache():
+    filepath = os.path.join(test_location, "x86_64", "fauxware")
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cold_ld = cle.Loader(filepath, cache_dir=cache_dir)
+        nose.tools.assert_equal(cold_ld._object_cache.hits, 0)
+        nose.tools.assert_true(len(os.listdir(cache_dir)) >= 2)
+
+        # the entries refer back to the files instead of holding copies of them
+        entries_size = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir))
+        files_size = sum(os.path.getsize(o.binary) for o in cold_ld.all_objects if o is not cold_ld.tls_object)
+        nose.tools.assert_less(entries_size, files_size / 2)
+
+        warm_ld = cle.Loader(filepath, cache_dir=cache_dir)
+        nose.tools.assert_equal(warm_ld._object_cache.hits,
+                                len([o for o in warm_ld.all_objects if o is not warm_ld.tls_object]))
+
+        nose.tools.assert_equal([(o.binary, o.rebase_addr) for o in cold_ld.all_objects],
+                                [(o.binary, o.rebase_addr) for o in warm_ld.all_objects])
+        nose.tools.assert_equal(sorted(cold_ld.main_bin.symbols_by_addr), sorted(warm_ld.main_bin.symbols_by_addr))
+        nose.tools.assert_equal(cold_ld.main_bin._plt, warm_ld.main_bin._plt)
+        nose.tools.assert_equal(cold_ld.memory.read_addr_at(0x601018), warm_ld.memory.read_addr_at(0x601018))
+        nose.tools.assert_equal(cold_ld.memory.read_bytes(cold_ld.main_bin.entry, 0x40),
+                                warm_ld.memory.read_bytes(warm_ld.main_bin.entry, 0x40))
+
+        # the libraries are loaded to be compatible with the new main binary, not the one they were cached with
+        nose.tools.assert_is(warm_ld.shared_objects['libc.so.6'].compatible_with, warm_ld.main_bin)
+    finally:
+        shutil.rmtree(cache_dir)
+
+class FakeObject(object):
+    def __init__(self, path):
+        self.binary = path
+        self.arch = None
+        self.compatible_with = None
+        self.memory = cle.Clemory(None)
+        self.memory.add_backer(0, cle.FileBacker(path, 0, 0x100))
+
+def test_object_cache_entries():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cache = cle.ObjectCache(os.path.join(tmp_dir, 'cache'))
+        first = os.path.join(tmp_dir, 'first')
+        second = os.path.join(tmp_dir, 'second')
+        for path in (first, second):
+            with open(path, 'wb') as f:
+                f.write('A' * 0x100)
+
+        # files with the same contents get entries of their own
+        first_key = cache.key(first, {})
+        second_key = cache.key(second, {})
+        nose.tools.assert_not_equal(first_key, second_key)
+        nose.tools.assert_true(cache.store(first_key, FakeObject(first)))
+        nose.tools.assert_is_none(cache.load(second_key))
+        nose.tools.assert_equal(cache.load(first_key).memory.read_bytes(0, 4), 'AAAA')
+
+        # an entry whose file changed under it is a miss, not a broken object
+        with open(first, 'r+b') as f:
+            f.write('B')
+        nose.tools.assert_is_none(cache.load(first_key))
+        nose.tools.assert_equal((cache.hits, cache.misses), (1, 2))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_shared_objects():
+    cle.shared_object_cache.clear()
+    first_ld = cle.Loader(os.path.join(test_location, "x86_64", "fauxware"), share_objects=True)
+    parsed = cle.shared_object_cache.misses
+    second_ld = cle.Loader(os.path.join(test_location, "x86_64", "fauxware"), share_objects=True)
+    nose.tools.assert_equal(cle.shared_object_cache.misses, parsed)
+
+    first_libc = first_ld.shared_objects['libc.so.6']
+    second_libc = second_ld.shared_objects['libc.so.6']
+    nose.tools.assert_is_not(first_libc, second_libc)
+    nose.tools.assert_is(first_libc.sections, second_libc.sections)
+
+    # the copies each read through tables of their own, which keep positions in their streams
+    third_ld = cle.Loader(os.path.join(test_location, "x86_64", "fauxware"), share_objects=True)
+    third_libc = third_ld.shared_objects['libc.so.6']
+    nose.tools.assert_is_not(second_libc.binary_stream, third_libc.binary_stream)
+    nose.tools.assert_is_not(second_libc.reader, third_libc.reader)
+    nose.tools.assert_is_not(second_libc.dynsym, third_libc.dynsym)
+
+    # each copy has its own relocations and symbols, bound to it
+    nose.tools.assert_is(second_libc.get_symbol('strcmp').owner_obj, second_libc)
+    nose.tools.assert_is_not(first_libc.get_symbol('strcmp'), second_libc.get_symbol('strcmp'))
+    nose.tools.assert_is(second_libc.symbols_by_addr[second_libc.get_symbol('strcmp').addr],
+                         second_libc.get_symbol('strcmp'))
+    nose.tools.assert_true(all(r.owner_obj is second_libc for r in second_libc.relocs))
+    nose.tools.assert_true(all(r.symbol.owner_obj is second_libc for r in second_libc.imports.itervalues()))
+    nose.tools.assert_equal([r.resolved for r in first_libc.relocs], [r.resolved for r in second_libc.relocs])
+    nose.tools.assert_is(second_libc.compatible_with, second_ld.main_bin)
+    nose.tools.assert_equal(first_libc.get_symbol('strcmp').rebased_addr, second_libc.get_symbol('strcmp').rebased_addr)
+
+    # writes to one loader's copy don't show up in the other's
+    addr = first_libc.get_symbol('strcmp').addr
+    original = second_libc.memory.read_bytes(addr, 4)
+    first_libc.memory.write_bytes(addr, '\xcc\xcc\xcc\xcc')
+    nose.tools.assert_equal(second_libc.memory.read_bytes(addr, 4), original)
+    cle.shared_object_cache.clear()
+
+if __name__ == '__main__':
+    test_object_cache()
+    test_object_cache_entries()
+    test_shared_objects()
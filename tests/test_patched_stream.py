@@ -21,3 +21,71 @@ def test_patched_stream():
     stream4 = cle.PatchedStream(stream, [(-1, 'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')])
     stream4.seek(0)
     nose.tools.assert_equal(stream4.read(), 'A'*0x10)
+
+def test_overlapping_patches():
+    stream = StringIO.StringIO('0123456789abcdef')
+
+    # later patches win over earlier ones, including ones from a stacked stream
+    stream1 = cle.PatchedStream(stream, [(2, 'AAAA'), (4, 'BBBB'), (1, 'C'), (12, 'DD')])
+    stream2 = cle.PatchedStream(stream1, [(5, 'E'), (13, 'FFFF')])
+    nose.tools.assert_equal(stream2.patches, [(1, 'C'), (2, 'AA'), (4, 'B'), (5, 'E'), (6, 'BB'), (12, 'D'),
+                                              (13, 'FFFF')])
+    stream2.seek(0)
+    nose.tools.assert_equal(stream2.read(), '0CAABEBB89abDFFF')
+
+    for start in xrange(16):
+        for end in xrange(start, 17):
+            stream2.seek(start)
+            nose.tools.assert_equal(stream2.read(end - start), '0CAABEBB89abDFFF'[start:end])
+
+def test_cached_stream():
+    stream = cle.BlockCachedStream(StringIO.StringIO(''.join(chr(i) for i in xrange(256)) * 4), block_size=0x100, max_blocks=2)
+
+    stream.seek(0xfe)
+    nose.tools.assert_equal(stream.read(4), '\xfe\xff\x00\x01')
+    nose.tools.assert_equal(stream.tell(), 0x102)
+    nose.tools.assert_equal(stream.read(1), '\x02')
+    stream.seek(0x10)
+    nose.tools.assert_equal(stream.read(2), '\x10\x11')
+    nose.tools.assert_equal((stream.hits, stream.misses), (2, 2))
+
+    # the least recently used block is evicted
+    stream.seek(0x210)
+    nose.tools.assert_equal(stream.read(1), '\x10')
+    stream.seek(0x110)
+    stream.read(1)
+    nose.tools.assert_equal((stream.hits, stream.misses), (2, 4))
+    nose.tools.assert_equal(stream.stats['saved'], 1)
+
+    # reads stop at the end of the stream, and large reads go straight to it
+    stream.seek(0x3fe)
+    nose.tools.assert_equal(stream.read(0x10), '\xfe\xff')
+    nose.tools.assert_equal(stream.read(0x10), '')
+    stream.seek(-0x101, 2)
+    nose.tools.assert_equal(len(stream.read()), 0x101)
+    stream.seek(0)
+    nose.tools.assert_equal(len(stream.read(0x300)), 0x300)
+
+    buf = bytearray(3)
+    stream.seek(0x41)
+    nose.tools.assert_equal(stream.readinto(buf), 3)
+    nose.tools.assert_equal(buf, 'ABC')
+
+    # clearing drops the blocks but not the position
+    stream.clear()
+    nose.tools.assert_equal(len(stream._blocks), 0)
+    nose.tools.assert_equal(stream.read(1), 'D')
+
+    # readinto copies across blocks, and also stops at the end of the stream
+    buf = bytearray(8)
+    stream.seek(0x2fe)
+    nose.tools.assert_equal(stream.readinto(buf), 8)
+    nose.tools.assert_equal(buf, '\xfe\xff\x00\x01\x02\x03\x04\x05')
+    stream.seek(0x3fe)
+    nose.tools.assert_equal(stream.readinto(buf), 2)
+    nose.tools.assert_equal(buf[:2], '\xfe\xff')
+    buf = bytearray(0x300)
+    stream.seek(0x10)
+    nose.tools.assert_equal(stream.readinto(buf), 0x300)
+    nose.tools.assert_equal(buf[:2], '\x10\x11')
+    nose.tools.assert_equal(stream.tell(), 0x310)